@@ -4,9 +4,15 @@ import getopt
 from os import listdir
 from discord.ext import commands
 
+import helpers.counting as counting
 import helpers.database as db
+import helpers.migrations as migrations
+import helpers.settings as settings
 from helpers.logger import Logger, Priority
-from helpers.env import DEBUG_GUILDS, TOKEN, shutdown_db
+from helpers.resolver import resolver
+from helpers.router import router
+from helpers.scheduler import scheduler
+from helpers.env import DEBUG_GUILDS, TOKEN
 
 
 intents = discord.Intents(messages=True, message_content=True,
@@ -21,6 +27,9 @@ bot = commands.Bot(intents=intents, command_prefix='%s',
 
 logger = Logger()
 logger.set_bot(bot)
+resolver.set_bot(bot)
+
+channel_cleanup = db.BatchedStatement("channel_cleanup")  # coalesces channel delete storms
 
 
 @bot.event
@@ -31,10 +40,11 @@ async def on_guild_join(guild: discord.Guild) -> None:
     Args:
         guild (discord.Guild): Guild that triggered the event
     """
-    db.single_void_SQL(
-        "INSERT INTO Guilds (ID, CountingChannelID, BirthdayChannelID, " +
-        "FactChannelID, CurrentCount, LastCounterID, HighScoreCounting, FailRoleID)" +
-        " VALUES (%s, NULL, NULL, NULL, 0, NULL, 0, NULL);", (guild.id,))
+    await db.single_void_SQL(
+        "INSERT INTO Guilds (ID, BirthdayChannelID, FactChannelID) VALUES (%s, NULL, NULL);",
+        (guild.id,))
+    settings.cache.add_guild(guild.id)
+    await settings.publish(["settings"], guild.id)
 
 
 @bot.event
@@ -45,32 +55,32 @@ async def on_guild_remove(guild: discord.Guild) -> None:
     Args:
         guild (discord.Guild): Guild that triggered the event
     """
-    db.multi_void_sql([
-        ("DELETE FROM Birthdays WHERE GuildID=%s", (guild.id,)),
-        ("DELETE FROM Subreddits WHERE GuildID=%s", (guild.id,)),
-        ("DELETE FROM ChainedUsers WHERE GuildID=%s", (guild.id,)),
-        ("DELETE FROM MessageChain WHERE GuildID=%s", (guild.id,)),
-        ("DELETE FROM RoleChannel WHERE GuildID=%s", (guild.id,)),
-        ("DELETE FROM ReactMessages WHERE GuildID=%s", (guild.id,)),
-        ("DELETE FROM Guilds WHERE ID=%s", (guild.id,))])
+    guild_settings = await settings.cache.get(guild.id)  # read before its rows are deleted
+    await db.named_void_sql("guild_cleanup", (guild.id,))  # cascades to all guild tables
+    for channel_id in guild_settings.counting if guild_settings else []:
+        counting.engine.remove(channel_id)
+    settings.cache.remove_guild(guild.id)
+    settings.chains.remove_guild(guild.id)
+    settings.role_channels.remove_guild(guild.id)
+    settings.react_roles.remove_guild(guild.id)
+    await settings.publish(list(settings.CACHES), guild.id)
 
 
 @bot.event
 async def on_guild_channel_delete(channel: discord.TextChannel) -> None:
     """
-    Called when guild channel is deleted, to delete hanging database entries
+    Called when guild channel is deleted, to delete hanging database entries.
+    Deletes are batched so a purge of many channels costs a single round trip
 
     Args:
         channel (discord.Channel): Channel that triggered the event
     """
-    db.multi_void_sql([
-        ("DELETE FROM Subreddits WHERE SubredditChannelID=%s", (channel.id,)),
-        ("DELETE FROM ChainedUsers WHERE ChannelID=%s", (channel.id,)),
-        (
-            "DELETE FROM MessageChain WHERE ChannelID=%s OR ResponseChannelID=%s",
-            (channel.id, channel.id)
-        ),
-        ("DELETE FROM RoleChannel WHERE ChannelID=%s", (channel.id,))])
+    settings.cache.remove_channel(channel.guild.id, channel.id)
+    counting.engine.remove(channel.id)
+    settings.chains.remove_channel(channel.guild.id, channel.id)
+    settings.role_channels.remove(channel.id)
+    await channel_cleanup.write(channel.id)  # other processes must reload without the rows
+    await settings.publish(["settings", "chains", "role_channels"], channel.guild.id, channel.id)
 
 
 @bot.event
@@ -81,23 +91,39 @@ async def on_member_remove(member: discord.Member) -> None:
     Args:
         member (discord.Member): Member that triggered the event
     """
-    db.multi_void_sql([
-        ("DELETE FROM Birthdays WHERE GuildID=%s AND UserID=%s", (member.guild.id, member.id)),
-        ("DELETE FROM ChainedUsers WHERE GuildID=%s AND UserID=%s", (member.guild.id, member.id))])
+    await db.named_void_sql("member_cleanup",
+                            (member.guild.id, member.id, member.guild.id, member.id))
+    settings.chains.remove_member(member.guild.id, member.id)
+    await settings.publish(["chains"], member.guild.id)
+
+
+@bot.listen("on_message")
+async def route_message(msg: discord.Message) -> None:
+    """
+    Called on every message, hands it to the features it concerns
+
+    Args:
+        msg (discord.Message): Message that triggered the event
+    """
+    await router.dispatch(msg, bot.user)
 
 
 @bot.event
 async def on_ready() -> None:
     if bot.user is not None:
         logger.info('Logged in', member_id=bot.user.id)
+    await settings.load()
+    scheduler.start()
 
 
 def main() -> None:
     priority = None
     test_req = False
     test_env = False
+    contract = False
 
-    opts, _ = getopt.getopt(sys.argv[1:], "iel:", ["logger-level=", "test-deps", "test_env"])
+    opts, _ = getopt.getopt(sys.argv[1:], "iecl:",
+                            ["logger-level=", "test-deps", "test_env", "contract-schema"])
     for opt, arg in opts:
         if opt in ["-l", "--logger-level"]:
             priority = Priority[arg.upper()].name
@@ -105,6 +131,8 @@ def main() -> None:
             test_req = True
         if opt in ["-e", "--test-env"]:
             test_env = True
+        if opt in ["-c", "--contract-schema"]:
+            contract = True
             
     if priority:
         logger.set_priority(priority)
@@ -112,7 +140,6 @@ def main() -> None:
         logger.info("No logging level set, defaulting to all")
 
     if __debug__:
-        db.populate()
         logger.debug_mode = True
         bot.load_extension("cogs.debug")
 
@@ -135,12 +162,22 @@ def main() -> None:
         if test_req:
             exit(0)
 
+    if contract:
+        migrations.migrate(contract=True)
+        exit(0)
+    migrations.migrate()
+    if __debug__:
+        db.populate()
+    counting.replay_journal()
+    db.open_db()
     try:
         bot.run(TOKEN)
     except KeyboardInterrupt:
         logger.warning("Keyboard interrupt: Failed to shutdown")
     finally:
-        shutdown_db()
+        counting.engine.close()
+        counting.replay_journal()
+        db.shutdown_db()
         logger.info("Bot succesfully shutdown")
 
 
@@ -1,16 +1,25 @@
 import discord
+import zoneinfo
 from discord.ext import commands
 
 from helpers.logger import Logger
 import helpers.database as db
+import helpers.settings as settings
+from helpers.resolver import resolver
+from helpers.roles import role_changes
+from helpers.router import router
 from helpers.style import Emotes
 from helpers.emoji import Emoji
 logger = Logger()
 
+TIME_ZONES = sorted(zoneinfo.available_timezones())
+
 
 class Admin(commands.Cog):
     def __init__(self, bot: discord.Bot) -> None:
         self.bot = bot
+        router.add("chain_message", self.chain_message, self.chain_channel)
+        router.add("assign_role", self.assign_role, self.role_channel_message)
 
     @commands.slash_command(
         name="send_react_message",
@@ -59,10 +68,13 @@ class Admin(commands.Cog):
         logger.debug(f"role={role}")
         if role:
             logger.debug(f"Message ID on insert: {message.id}")
-            db.single_void_SQL(
+            await db.single_void_SQL(
                 "INSERT INTO ReactMessages VALUES (%s, %s, %s, %s)",
                 (ctx.guild_id, message.id, role.id, true_emoji.as_text())
             )
+            settings.react_roles.add_role(
+                ctx.guild_id, message.id, true_emoji.to_partial_emoji(), role.id)
+            await settings.publish(["react_roles"], ctx.guild_id, message.id)
         await ctx.respond(f"Message Sent! {Emotes.HEART}")
 
     @discord.slash_command(name="remove_single_role_assignment",
@@ -71,9 +83,12 @@ class Admin(commands.Cog):
     @discord.commands.option("role", type=discord.Role,
                              description="The role to remove assignment for")
     async def remove_single_role(self, ctx: discord.ApplicationContext, role: discord.Role) -> None:
-        db.multi_void_sql([
+        await db.multi_void_sql([
             ("DELETE FROM RoleChannel WHERE GuildID=%s AND RoleID=%s", (ctx.guild_id, role.id)),
             ("DELETE FROM ReactMessages WHERE GuildID=%s AND RoleID=%s", (ctx.guild_id, role.id))])
+        settings.role_channels.remove_role(ctx.guild_id, role.id)
+        settings.react_roles.remove_role(ctx.guild_id, role.id)
+        await settings.publish(["role_channels", "react_roles"], ctx.guild_id)
         await ctx.respond(f"All role assign behaviours have been cleared for {role.name}")
 
     @discord.slash_command(name="clear_role_setting",
@@ -82,10 +97,13 @@ class Admin(commands.Cog):
     @discord.commands.default_permissions(manage_guild=True)
     async def delete_react_entry(self, ctx: discord.ApplicationContext) -> None:
         logger.info("Dropping react entries", guild_id=ctx.guild_id)
-        db.multi_void_sql([
+        await db.multi_void_sql([
             ("DELETE FROM ReactMessages WHERE GuildID=%s", (ctx.guild_id,)),
             ("DELETE FROM RoleChannel WHERE GuildID=%s", (ctx.guild_id,))
         ])
+        settings.role_channels.remove_guild(ctx.guild_id)
+        settings.react_roles.remove_guild(ctx.guild_id)
+        await settings.publish(["role_channels", "react_roles"], ctx.guild_id)
         await ctx.respond("All role assign behaviours have been cleared")
 
     @discord.slash_command(name='set_role_channel',
@@ -98,9 +116,11 @@ class Admin(commands.Cog):
         channel: discord.TextChannel,
         role: discord.Role
     ) -> None:
-        db.single_void_SQL(
+        await db.single_void_SQL(
             "INSERT INTO RoleChannel VALUES (%s, %s, %s, TRUE)",
             (ctx.guild_id, role.id, channel.id))
+        settings.role_channels.add_rule(ctx.guild_id, channel.id, role.id, True)
+        await settings.publish(["role_channels"], ctx.guild_id, channel.id)
         await ctx.respond(f"Role channel was set to {channel.mention}")
 
     @discord.slash_command(name='set_remove_role_channel',
@@ -113,11 +133,33 @@ class Admin(commands.Cog):
         channel: discord.TextChannel,
         role: discord.Role
     ) -> None:
-        db.single_void_SQL(
+        await db.single_void_SQL(
             "INSERT INTO RoleChannel VALUES (%s, %s, %s, FALSE)",
             (ctx.guild_id, role.id, channel.id))
+        settings.role_channels.add_rule(ctx.guild_id, channel.id, role.id, False)
+        await settings.publish(["role_channels"], ctx.guild_id, channel.id)
         await ctx.respond(f"Role remove channel was set to {channel.mention}")
 
+    @discord.slash_command(name='set_timezone',
+                           description="Sets the time zone the daily posts of the server follow")
+    @discord.commands.option("time_zone", type=str, required=False,
+                             description="Time zone name, e.g. Europe/London (UTC if not given)",
+                             autocomplete=discord.utils.basic_autocomplete(TIME_ZONES))
+    @discord.commands.default_permissions(manage_guild=True)
+    async def set_timezone(self, ctx: discord.ApplicationContext, time_zone: str) -> None:
+        if time_zone and time_zone not in TIME_ZONES:
+            await ctx.respond(f"Sorry, I don't know the time zone '{time_zone}' {Emotes.CONFUSED}",
+                              ephemeral=True)
+            return
+        await db.single_void_SQL("UPDATE Guilds SET TimeZone=%s WHERE ID=%s",
+                                 (time_zone or None, ctx.guild_id))
+        settings.cache.set_time_zone(ctx.guild_id, time_zone or None)
+        await settings.publish(["settings"], ctx.guild_id)
+        await ctx.respond(f"Daily posts now follow {time_zone or 'UTC'} {Emotes.DRINKING}",
+                          ephemeral=True)
+        logger.debug(f"Time zone set to {time_zone}", member_id=ctx.user.id,
+                     guild_id=ctx.guild_id)
+
     @discord.commands.slash_command(
         name="set_chain_message",
         description="allows Nix to follow up with custom messages whenever a user send a message")
@@ -139,10 +181,12 @@ class Admin(commands.Cog):
     ) -> None:
         channel_id = message_channel.id if message_channel is not None else -1
         try:
-            db.single_void_SQL(
+            await db.single_void_SQL(
                 "INSERT INTO MessageChain VALUES (%s,%s,%s,%s)",
                 (ctx.guild_id, channel_id, response_channel.id, message)
             )
+            settings.chains.add_chain(ctx.guild_id, channel_id, response_channel.id, message)
+            await settings.publish(["chains"], ctx.guild_id)
             await ctx.respond(f"You set a chain_message for the channel {response_channel}")
         except db.KeyViolation:
             await ctx.respond(
@@ -153,66 +197,58 @@ class Admin(commands.Cog):
                             description="Clears all chain message behaviours")
     @discord.commands.default_permissions(manage_guild=True)
     async def clear_chain_message(self, ctx: discord.ApplicationContext) -> None:
-        db.multi_void_sql([
-            ("DELETE FROM ChainedUsers WHERE GuildID=%s", (ctx.guild_id,)),
-            ("DELETE FROM MessageChain WHERE GuildID=%s", (ctx.guild_id,))
-        ])
+        await db.single_void_SQL(  # cascades to ChainedUsers
+            "DELETE FROM MessageChain WHERE GuildID=%s", (ctx.guild_id,))
+        if ctx.guild_id:
+            settings.chains.remove_guild(ctx.guild_id)
+            await settings.publish(["chains"], ctx.guild_id)
+
+    @staticmethod
+    async def chain_channel(msg: discord.Message) -> bool:
+        chains = await settings.chains.get(msg.guild.id) if msg.guild else None
+        return chains is not None and (msg.channel.id in chains.responses
+                                       or -1 in chains.responses)
 
-    @commands.Cog.listener('on_message')
     async def chain_message(self, msg: discord.Message) -> None:
-        if isinstance(msg.channel, discord.abc.PrivateChannel):
-            logger.info("chain_message activated in Private channel")
-            return
         if msg.guild is None:
             logger.error("Couldnt get guild", member_id=msg.author.id)
             return
-        if self.bot.user is None:
-            logger.error("Bot is offline", channel_id=msg.channel.id)
+        chains = await settings.chains.get(msg.guild.id)
+        if chains is None:
+            return
+        watched = msg.channel.id if msg.channel.id in chains.responses else -1
+        if watched not in chains.responses:
             return
-        if msg.author.id != self.bot.user.id:
-            values = db.single_sql(
-                "SELECT WatchedChannelID FROM MessageChain WHERE GuildID=%s", (msg.guild.id,))
-            if values is not None:
-                check_vals = [val[0] for val in values]
-                if msg.channel.id in check_vals or -1 in check_vals:
-                    try:
-                        db.single_void_SQL(
-                            "INSERT INTO ChainedUsers VALUES (%s, %s, %s)",
-                            (msg.guild.id, msg.author.id, msg.channel.id
-                             if msg.channel.id in check_vals else -1))
-                        await self.send_chained_message(msg.guild, msg.author)
-                    except db.KeyViolation:
-                        logger.info(
-                            "User that is already chained has written in the channel again",
-                            member_id=msg.author.id, guild_id=msg.guild.id
-                        )
+        if msg.author.id in chains.chained[watched]:
+            logger.debug(
+                "User that is already chained has written in the channel again",
+                member_id=msg.author.id, guild_id=msg.guild.id
+            )
+            return
+        chained = await db.named_sql("chain_user", (msg.guild.id, msg.author.id, watched))
+        settings.chains.add_chained(msg.guild.id, watched, msg.author.id)
+        if chained:
+            await self.send_chained_message(
+                msg.guild, msg.author, list(chains.responses.values()))
+
+    @staticmethod
+    async def role_channel_message(msg: discord.Message) -> bool:
+        return (isinstance(msg.author, discord.Member)
+                and bool(await settings.role_channels.get(msg.channel.id)))
 
-    @commands.Cog.listener('on_message')
     async def assign_role(self, msg: discord.Message) -> None:
-        if isinstance(msg.channel, discord.abc.PrivateChannel):
-            logger.info("assign_role activated in Private channel")
-            return
         if msg.guild is None:
             logger.error("Couldnt get guild", member_id=msg.author.id)
             return
-        if self.bot.user is None:
-            logger.error("Bot is offline")
-            return
         if not isinstance(msg.author, discord.Member):
             logger.info("Author is not member (likely: user not in guild)")
             return
-        if msg.author.id != self.bot.user.id:
-            vals = db.single_sql(
-                "SELECT RoleID, ToAdd FROM RoleChannel WHERE ChannelID=%s", (msg.channel.id,))
-            for (role_id, add_role) in vals:
-                role = msg.guild.get_role(role_id)
-                if role:
-                    if add_role:
-                        await msg.author.add_roles(role)
-                    else:
-                        await msg.author.remove_roles(role)
-                else:
-                    logger.error("Couldnt get role for msg role (un)assign")
+        rules = await settings.role_channels.get(msg.channel.id)
+        for role_id in rules:
+            if msg.guild.get_role(role_id) is None:
+                logger.error("Couldnt get role for msg role (un)assign")
+        await role_changes.change(msg.author, {role_id: add_role for (role_id, add_role)
+                                               in rules.items() if msg.guild.get_role(role_id)})
 
     @commands.Cog.listener('on_raw_reaction_add')
     async def assign_react_role(self, event: discord.RawReactionActionEvent) -> None:
@@ -224,18 +260,14 @@ class Admin(commands.Cog):
         if event.member is None:
             logger.info("reaction event has no member (likely: user not in guild)")
             return
-        logger.debug(f"Message ID on reaction: {event.message_id}")
-        vals = db.single_sql(
-            "SELECT Emoji, RoleID FROM ReactMessages WHERE MessageID=%s", (event.message_id,))
-        logger.debug(f"SQL values: {vals}")
-        for (emoji, role_id) in vals:
-            if Emoji(emoji).to_partial_emoji() == event.emoji:
-                logger.debug("adding role")
-                role = event.member.guild.get_role(role_id)
-                if role:
-                    await event.member.add_roles(role)
-                else:
-                    logger.error("Couldnt get role for react role assign")
+        roles: dict[int, bool] = {}
+        for role_id in await settings.react_roles.get(event.message_id, event.emoji):
+            logger.debug("adding role")
+            if event.member.guild.get_role(role_id):
+                roles[role_id] = True
+            else:
+                logger.error("Couldnt get role for react role assign")
+        await role_changes.change(event.member, roles)
 
     @commands.Cog.listener('on_raw_reaction_remove')
     async def unassign_react_role(self, event: discord.RawReactionActionEvent) -> None:
@@ -243,27 +275,26 @@ class Admin(commands.Cog):
             logger.info("unassign_react_role detected outside of guild",
                         channel_id=event.channel_id)
             return
-        vals = db.single_sql(
-            "SELECT Emoji, RoleID FROM ReactMessages WHERE MessageID=%s", (event.message_id,))
-        for (emoji, role_id) in vals:
-            if Emoji(emoji).to_partial_emoji() == event.emoji:
-                logger.debug("removing role")
-                guild = await self.bot.fetch_guild(event.guild_id)
-                member = await guild.fetch_member(event.user_id)
-                role = guild.get_role(role_id)
-                if role:
-                    await member.remove_roles(role)
-                else:
-                    logger.error("Couldnt get role for react role unassign")
+        role_ids = await settings.react_roles.get(event.message_id, event.emoji)
+        if not role_ids:
+            return
+        member = await resolver.member(event.guild_id, event.user_id)
+        roles: dict[int, bool] = {}
+        for role_id in role_ids:
+            logger.debug("removing role")
+            if member.guild.get_role(role_id):
+                roles[role_id] = False
+            else:
+                logger.error("Couldnt get role for react role unassign")
+        await role_changes.change(member, roles)
 
     @staticmethod
     async def send_chained_message(
         guild: discord.Guild,
-        user: discord.User | discord.Member
+        user: discord.User | discord.Member,
+        responses: list[tuple[int, str]]
     ) -> None:
-        vals = db.single_sql(
-            "SELECT ResponseChannelID, Message FROM MessageChain WHERE GuildID=%s", (guild.id,))
-        for (response_channel_id, message) in vals:
+        for (response_channel_id, message) in responses:
             msg = message.replace("<<user>>", user.mention)
             try:
                 channel = guild.get_channel(response_channel_id)
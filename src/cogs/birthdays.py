@@ -1,21 +1,27 @@
 import discord
+import calendar
 import datetime as dt
-from discord.ext import commands, tasks
+import functools
+from discord.ext import commands
 
 import helpers.database as db
-from helpers.style import Emotes, Colours, TIME, RESET
+import helpers.settings as settings
+from helpers.broadcast import broadcast
+from helpers.resolver import mention
+from helpers.scheduler import scheduler
+from helpers.style import Emotes, Colours
 from helpers.logger import Logger
 logger = Logger()
 
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+UPCOMING_DAYS = 7
 
 
 class Birthdays(commands.Cog):
     def __init__(self, bot: discord.Bot) -> None:
         self.bot = bot
-        self.daily_bday.start()
-        self.sent_today = False
-        self.reset_bday.start()
+        scheduler.add("daily birthday", self.daily_bday,
+                      lambda guild: guild.birthday_channel is not None)
 
     @commands.slash_command(name='set_birthday_channel',
                             description="Sets the channel for the birthday messages")
@@ -25,8 +31,10 @@ class Birthdays(commands.Cog):
         ctx: discord.ApplicationContext,
         channel: discord.TextChannel
     ) -> None:
-        db.single_void_SQL("UPDATE Guilds SET BirthdayChannelID=%s WHERE ID=%s",
-                           (channel.id, ctx.guild_id))
+        await db.single_void_SQL("UPDATE Guilds SET BirthdayChannelID=%s WHERE ID=%s",
+                                 (channel.id, ctx.guild_id))
+        settings.cache.set_birthday_channel(ctx.guild_id, channel.id)
+        await settings.publish(["settings"], ctx.guild_id)
         await ctx.respond(
             f"Birthday channel set to {channel.mention} {Emotes.DRINKING}",
             ephemeral=True
@@ -43,11 +51,11 @@ class Birthdays(commands.Cog):
             await ctx.respond(f"Sorry, I didn't understand the birthday '{day} {month}'" +
                               f" Are you sure it a valid day? {Emotes.CONFUSED}")
             return
-        db.single_void_SQL(
-            "INSERT INTO Birthdays (GuildID, UserID, Birthdate) VALUES (%s, %s, %s) ON CONFLICT " +
-            "(GuildID, UserID) DO UPDATE SET Birthdate=%s",
-            (ctx.guild.id, ctx.author.id, month + str(day),
-             month + str(day)))
+        await db.single_void_SQL(
+            "INSERT INTO Birthdays (GuildID, UserID, BirthMonth, BirthDay) VALUES " +
+            "(%s, %s, %s, %s) ON CONFLICT (GuildID, UserID) DO UPDATE SET " +
+            "BirthMonth=EXCLUDED.BirthMonth, BirthDay=EXCLUDED.BirthDay",
+            (ctx.guild.id, ctx.author.id, MONTHS.index(month) + 1, day))
         await ctx.respond(
             f"{ctx.author.mention} your birthday is set to {day} {month} {Emotes.UWU}"
         )
@@ -57,11 +65,12 @@ class Birthdays(commands.Cog):
                             description="Shows all tracked birthdays for the server")
     @discord.commands.default_permissions(manage_guild=True)
     async def show_birthdays(self, ctx: discord.ApplicationContext) -> None:
-        vals = db.single_sql(
-            "SELECT UserID, Birthdate from Birthdays WHERE GuildID=%s", (ctx.guild_id,))
+        vals = await db.single_sql(
+            "SELECT UserID, BirthMonth, BirthDay from Birthdays WHERE GuildID=%s " +
+            "ORDER BY BirthMonth, BirthDay", (ctx.guild_id,))
         if vals:
             out_str = "\n".join(
-                [(await self.bot.fetch_user(user[0])).mention + " : " + user[1] for user in vals]
+                [mention(user[0]) + f" : {user[2]} {MONTHS[user[1] - 1]}" for user in vals]
             )
         else:
             out_str = "No users have entered their birthday yet! Get started with " +\
@@ -69,43 +78,70 @@ class Birthdays(commands.Cog):
         embed = discord.Embed(title="Birthday List", description=out_str, color=Colours.PRIMARY)
         await ctx.respond(embed=embed)
 
-    @tasks.loop(time=RESET)
-    async def reset_bday(self) -> None:
-        self.sent_today = False
+    @commands.slash_command(name='upcoming_birthdays',
+                            description="Shows birthdays in the server over the next week")
+    async def upcoming_birthdays(self, ctx: discord.ApplicationContext) -> None:
+        start = dt.date.today()
+        end = start + dt.timedelta(days=UPCOMING_DAYS)
+        if (start.month, start.day) <= (end.month, end.day):
+            vals = await db.single_sql(
+                "SELECT UserID, BirthMonth, BirthDay FROM Birthdays WHERE GuildID=%s AND " +
+                "(BirthMonth, BirthDay) >= (%s, %s) AND (BirthMonth, BirthDay) <= (%s, %s) " +
+                "ORDER BY BirthMonth, BirthDay",
+                (ctx.guild_id, start.month, start.day, end.month, end.day))
+        else:  # wraps around the new year
+            vals = await db.single_sql(
+                "SELECT UserID, BirthMonth, BirthDay FROM Birthdays WHERE GuildID=%s AND " +
+                "((BirthMonth, BirthDay) >= (%s, %s) OR (BirthMonth, BirthDay) <= (%s, %s)) " +
+                "ORDER BY BirthMonth < %s, BirthMonth, BirthDay",
+                (ctx.guild_id, start.month, start.day, end.month, end.day, start.month))
+        if vals:
+            out_str = "\n".join(
+                [mention(user[0]) + f" : {user[2]} {MONTHS[user[1] - 1]}" for user in vals]
+            )
+        else:
+            out_str = f"No birthdays in the next week {Emotes.CRYING}"
+        embed = discord.Embed(title="Upcoming Birthdays", description=out_str,
+                              color=Colours.PRIMARY)
+        await ctx.respond(embed=embed)
 
-    @tasks.loop(time=TIME)
-    async def daily_bday(self) -> None:
+    async def daily_bday(self, guild_ids: list[int], day: dt.date) -> set[int]:
         """
-        Called daily to check for, and congratulate birthdays to birthday channel
+        Called daily (by the scheduler) to check for, and congratulate birthdays to birthday
+        channel of due guilds
+
+        Args:
+            guild_ids (list[int]): IDs of the guilds whose birthdays are due
+            day (dt.date): local day of the guilds
+
+        Returns:
+            set[int]: IDs of the guilds to retry
         """
-        if self.sent_today:
-            return
-        self.sent_today = True
-        logger.info("Starting daily birthday loop")
-        today = dt.date.today().strftime("%b%e").replace(" ", "")
-        val = db.single_sql(
-            "SELECT BirthdayChannelID, string_agg(UserID::varchar, \' \') FROM Birthdays " +
-            "INNER JOIN Guilds ON Birthdays.GuildID=Guilds.ID WHERE Birthdays.Birthdate=%s " +
-            "GROUP BY ID;", (today,))
-        for guild in val:
-            users = " ".join(
-                [(await self.bot.fetch_user(int(user))).mention for user in guild[1].split(" ")]
-            )
-            if guild[0]:
-                logger.debug("Attempting to send birthday message", channel_id=guild[0])
-                try:
-                    channel = await self.bot.fetch_channel(guild[0])
-                    if (not isinstance(channel, discord.abc.Messageable) or
-                            isinstance(channel, discord.abc.PrivateChannel)):
-                        logger.error("Birthday channel set to Private Channel",
-                                     channel_id=channel.id)
-                        continue
-                    (await channel
-                        .send("Happy Birthday to: " + users +
-                              f"!\nHope you have a brilliant day {Emotes.HEART}"))
-                except discord.errors.Forbidden:
-                    logger.info("Permission failure for sending birthday message",
-                                channel_id=guild[0])
+        logger.info(f"Starting daily birthdays of {day} for {len(guild_ids)} guilds")
+        last_day = day.day
+        if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+            last_day = 29  # 29 Feb birthdays are celebrated on the 28th in common years
+        val = await db.single_sql(
+            "SELECT ID, BirthdayChannelID, string_agg(UserID::varchar, \' \') FROM Birthdays " +
+            "INNER JOIN Guilds ON Birthdays.GuildID=Guilds.ID WHERE Birthdays.BirthMonth=%s " +
+            "AND Birthdays.BirthDay BETWEEN %s AND %s AND Guilds.ID = ANY(%s) GROUP BY ID;",
+            (day.month, day.day, last_day, guild_ids))
+        summary = await broadcast(self.bot, "daily birthday", [
+            (guild[1], functools.partial(self.congratulate, guild[2].split(" ")))
+            for guild in val if guild[1]])
+        return summary.retry({guild[0]: {guild[1]} for guild in val if guild[1]})
+
+    async def congratulate(self, user_ids: list[str], channel: discord.abc.Messageable) -> None:
+        """
+        Sends the birthday message of a guild
+
+        Args:
+            user_ids (list[str]): IDs of the users with their birthday today
+            channel (discord.abc.Messageable): Birthday channel of the guild
+        """
+        users = " ".join([mention(int(user)) for user in user_ids])
+        await channel.send("Happy Birthday to: " + users +
+                           f"!\nHope you have a brilliant day {Emotes.HEART}")
 
 
 def setup(bot: discord.Bot) -> None:
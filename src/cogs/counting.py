@@ -1,63 +1,187 @@
 import discord
 import asyncio
+import collections
+import weakref
 from discord.ext import commands
 
 import helpers.database as db
+import helpers.settings as settings
+from helpers.counting import engine, NotCounting
+from helpers.env import COUNTING_REACTIONS
 from helpers.style import Emotes
 from helpers.logger import Logger
+from helpers.roles import role_changes
+from helpers.router import router
 
 logger = Logger()
 
+REACTION_BACKLOG = 3  # queued reactions in a channel before the reaction policy applies
+MILESTONE = 100  # counts reacted to by the "milestones" policy
+
+
+class ChannelLocks:
+    """
+    A lock per channel, so channels count in parallel while each one stays in order.
+    Locks are held weakly and dropped once nothing holds or waits on them, so only
+    channels with counts in flight have one
+    """
+
+    def __init__(self) -> None:
+        self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = \
+            weakref.WeakValueDictionary()
+
+    def __call__(self, channel_id: int) -> asyncio.Lock:
+        """
+        Gets the lock of a channel, creating it if no count is in flight there
+
+        Args:
+            channel_id (int): ID of the channel
+
+        Returns:
+            asyncio.Lock: lock of the channel
+        """
+        lock = self._locks.get(channel_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[channel_id] = lock
+        return lock
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class ReactionQueue:
+    """
+    Reacts to correct counts behind the game, one queue per channel so rate limits of a
+    busy channel hold up nothing else. While a channel's queue is backed up only the
+    counts selected by the policy get a reaction: "every" count (default), every Nth
+    (a number N) or "milestones"
+
+    Args:
+        policy (str | None): reaction policy while backed up
+    """
+
+    def __init__(self, policy: str | None) -> None:
+        if not policy or policy == "every":
+            self.every = 1
+        elif policy == "milestones":
+            self.every = MILESTONE
+        elif policy.isdecimal() and int(policy) >= 1:
+            self.every = int(policy)
+        else:
+            logger.warning(f"Invalid counting reaction policy '{policy}', reacting to every count")
+            self.every = 1
+        self.skipped = 0
+        self._queues: dict[int, collections.deque[tuple[discord.Message, int]]] = {}
+        self._workers: dict[int, asyncio.Task[None]] = {}
+
+    def add(self, msg: discord.Message, number: int) -> None:
+        """
+        Queues the reaction to a correct count
+
+        Args:
+            msg (discord.Message): Message of the count
+            number (int): number counted
+        """
+        self._queues.setdefault(msg.channel.id, collections.deque()).append((msg, number))
+        if msg.channel.id not in self._workers:
+            self._workers[msg.channel.id] = asyncio.create_task(self._drain(msg.channel.id))
+
+    async def _drain(self, channel_id: int) -> None:
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                (msg, number) = queue.popleft()
+                if len(queue) >= REACTION_BACKLOG and number % self.every:
+                    self.skipped += 1
+                    continue
+                try:
+                    await msg.add_reaction(Emotes.BLEP)
+                except discord.HTTPException as err:
+                    logger.warning(f"Failed to react to count: {err}", channel_id=channel_id)
+        finally:
+            del self._queues[channel_id]
+            del self._workers[channel_id]
+
 
 class Counting(commands.Cog):
     def __init__(self) -> None:
-        self.lock = asyncio.Lock()
+        self.locks = ChannelLocks()
+        self.reactions = ReactionQueue(COUNTING_REACTIONS)
+        router.add("counting", self.count, self.counting_message)
+
+    @staticmethod
+    async def counting_message(msg: discord.Message) -> bool:
+        """
+        Checks whether a message is a number sent in a counting channel
+
+        Args:
+            msg (discord.Message): Message to check
+
+        Returns:
+            bool: True if the message is a count
+        """
+        if not msg.content.isdigit() or msg.guild is None:
+            return False
+        guild_settings = await settings.cache.get(msg.guild.id)
+        return guild_settings is not None and msg.channel.id in guild_settings.counting
 
-    @commands.Cog.listener("on_message")
     async def count(self, msg: discord.Message) -> None:
         """
-        Triggered on all messages, used to check for counting game
+        Routed counting messages, used to play the counting game
 
         Args:
             msg (discord.Message): Message that triggered function
         """
-        async with self.lock:
-            if msg.content.isdigit():
-                if msg.guild is None:
-                    return
-                values = db.single_sql(
-                    "SELECT CountingChannelID, CurrentCount, LastCounterID, "
-                    "FailRoleID FROM Guilds WHERE ID=%s", (msg.guild.id,))
-                (chnl_id, curr_ct, last_ctr_id, fail_id) = values[0]
-                if msg.channel.id == chnl_id:
-                    logger.debug("Integer message detacted in counting channel")
-                    if int(msg.content) != curr_ct + 1:
-                        logger.debug("Wrong number detected in counting channel")
-                        await self.fail(msg, "Wrong number", fail_id)
-                    elif msg.author.id == last_ctr_id:
-                        logger.debug("Double-user-input detected in counting channel")
-                        await self.fail(msg, "Same user entered two numbers", fail_id)
-                    else:
-                        await msg.add_reaction(Emotes.BLEP)
-                        db.single_void_SQL(
-                            "UPDATE Guilds SET LastCounterID =%s, CurrentCount = CurrentCount+1, " +
-                            "HighScoreCounting=(CASE WHEN %s>HighScoreCounting THEN %s ELSE " +
-                            "HighScoreCounting END) WHERE ID =%s",
-                            (msg.author.id, msg.content, msg.content, msg.guild.id))
+        if msg.guild is None:
+            return
+        async with self.locks(msg.channel.id):
+            logger.debug("Integer message detacted in counting channel")
+            try:
+                err_txt = await engine.count(msg.channel.id, msg.author.id, int(msg.content))
+            except NotCounting:
+                return
+            if not err_txt:
+                self.reactions.add(msg, int(msg.content))
+                return
+        logger.debug(f"{err_txt} in counting channel")
+        guild_settings = await settings.cache.get(msg.guild.id)
+        await self.fail(msg, err_txt, guild_settings.counting.get(msg.channel.id)
+                        if guild_settings else None)
 
     @commands.slash_command(name='set_fail_role',
                             description="Sets the role the given to users who fail at counting")
+    @discord.commands.option("channel", type=discord.TextChannel, required=False,
+                             description="Counting channel to set it for (default all)")
     @discord.commands.default_permissions(manage_guild=True)
-    async def set_fail_role(self, ctx: discord.ApplicationContext, role: discord.Role) -> None:
+    async def set_fail_role(
+        self,
+        ctx: discord.ApplicationContext,
+        role: discord.Role,
+        channel: discord.TextChannel
+    ) -> None:
         logger.info("fail_role set")
-        db.single_void_SQL("UPDATE Guilds SET FailRoleID=%s WHERE ID=%s",
-                           (role.id, ctx.guild_id))
+        if channel:
+            updated = await db.single_sql(
+                "UPDATE Counting SET FailRoleID=%s WHERE GuildID=%s AND ChannelID=%s " +
+                "RETURNING ChannelID", (role.id, ctx.guild_id, channel.id))
+        else:
+            updated = await db.single_sql(
+                "UPDATE Counting SET FailRoleID=%s WHERE GuildID=%s RETURNING ChannelID",
+                (role.id, ctx.guild_id))
+        if not updated:
+            await ctx.respond(f"You need to set a counting channel first {Emotes.CONFUSED}",
+                              ephemeral=True)
+            return
+        for (channel_id,) in updated:
+            settings.cache.set_fail_role(ctx.guild_id, channel_id, role.id)
+        await settings.publish(["settings"], ctx.guild_id)
         await ctx.respond(
             f"The fail role is set to {role.mention} {Emotes.DRINKING}", ephemeral=True
         )
 
     @commands.slash_command(name='set_counting_channel',
-                            description="Sets the channel for the counting game")
+                            description="Adds a channel for the counting game")
     @discord.commands.default_permissions(manage_guild=True)
     async def set_counting_channel(
         self,
@@ -65,46 +189,81 @@ class Counting(commands.Cog):
         channel: discord.TextChannel
     ) -> None:
         logger.info("counting_channel set")
-        db.single_void_SQL("UPDATE Guilds SET CountingChannelID=%s WHERE ID=%s",
-                           (channel.id, ctx.guild_id))
+        await db.single_void_SQL(
+            "INSERT INTO Counting (ChannelID, GuildID) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (channel.id, ctx.guild_id))
+        settings.cache.add_counting(ctx.guild_id, channel.id)
+        await settings.publish(["settings"], ctx.guild_id)
         await ctx.respond(
             f"Counting channel set to {channel.mention} {Emotes.DRINKING}", ephemeral=True
         )
 
+    @commands.slash_command(
+        name='stop_counting',
+        description="Stops the counting game in a channel (run set_counting_channel to restart)"
+    )
+    @discord.commands.default_permissions(manage_guild=True)
+    async def stop_counting(
+        self,
+        ctx: discord.ApplicationContext,
+        channel: discord.TextChannel
+    ) -> None:
+        await db.single_void_SQL("DELETE FROM Counting WHERE GuildID=%s AND ChannelID=%s",
+                                 (ctx.guild_id, channel.id))
+        settings.cache.remove_counting(ctx.guild_id, channel.id)
+        engine.remove(channel.id)
+        await settings.publish(["settings"], ctx.guild_id)
+        await ctx.respond(f"Stopped counting in {channel.mention} {Emotes.NOEMOTION}",
+                          ephemeral=True)
+        logger.debug("Counting channel unset", member_id=ctx.user.id, channel_id=channel.id)
+
     @commands.slash_command(name='get_highscore',
                             description="Shows you the highest count your server has reached")
-    async def get_highscore(self, ctx: discord.ApplicationContext) -> None:
-        highscore = db.single_sql(
-            "SELECT HighScoreCounting FROM Guilds WHERE ID = %s", (ctx.guild.id,))
-        await ctx.respond(f"Your server highscore is {highscore[0][0]}! {Emotes.WHOA}")
+    @discord.commands.option("channel", type=discord.TextChannel, required=False,
+                             description="Counting channel to show (default best in server)")
+    async def get_highscore(
+        self,
+        ctx: discord.ApplicationContext,
+        channel: discord.TextChannel
+    ) -> None:
+        await engine.flush()
+        if channel:
+            highscore = await db.single_sql(
+                "SELECT MAX(HighScore) FROM Counting WHERE GuildID=%s AND ChannelID=%s",
+                (ctx.guild_id, channel.id))
+        else:
+            highscore = await db.single_sql(
+                "SELECT MAX(HighScore) FROM Counting WHERE GuildID=%s", (ctx.guild_id,))
+        await ctx.respond(f"Your server highscore is {highscore[0][0] or 0}! {Emotes.WHOA}")
 
     @staticmethod
-    async def fail(msg: discord.Message, err_txt: str, roleID: int) -> None:
+    async def fail(msg: discord.Message, err_txt: str, roleID: int | None) -> None:
         """
-        Handles a generic counting failure
+        Handles a generic counting failure (the count itself is reset by the caller)
 
         Args:
             msg (discord.Message): Message that failed
             err_txt (string): Failure message to print to channel
-            roleID (int): ID of role to assign to user that failed
+            roleID (int | None): ID of role to assign to user that failed
         """
         if msg.guild is None or not isinstance(msg.author, discord.Member):
             return
-        db.single_void_SQL(
-            "UPDATE Guilds SET CurrentCount=0, LastCounterID=NULL WHERE ID=%s", (msg.guild.id,))
         await msg.add_reaction(Emotes.CRYING)
         await msg.channel.send(f"Counting Failed {Emotes.CRYING} {err_txt}")
-        role = msg.guild.get_role(roleID)
+        role = msg.guild.get_role(roleID) if roleID else None
         if role:
             try:
-                await msg.author.add_roles(role, reason="failed the counting")
+                await role_changes.change(msg.author, {role.id: True}, reason="failed the counting")
             except discord.errors.Forbidden:
                 logger.warning("Missing permission to assign fail_role")
                 await msg.channel.send("Whoops! I couldn't set the " +
                                        f"{role.mention} role {Emotes.CONFUSED} " +
                                        "(I need 'Manage Roles' to do that)" +
                                        "\nI won't try again until you set a new fail role")
-                db.single_void_SQL("UPDATE Guilds SET FailRoleID=NULL WHERE ID=%s", (msg.guild.id,))
+                await db.single_void_SQL(
+                    "UPDATE Counting SET FailRoleID=NULL WHERE ChannelID=%s", (msg.channel.id,))
+                settings.cache.set_fail_role(msg.guild.id, msg.channel.id, None)
+                await settings.publish(["settings"], msg.guild.id)
         else:
             logger.error("Couldnt get fail role for counting")
 
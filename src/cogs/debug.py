@@ -3,6 +3,9 @@ from discord.ext import commands
 
 from helpers.logger import Logger
 import helpers.database as db
+import helpers.metrics as metrics
+from helpers.roles import role_changes
+from helpers.router import router
 
 logger = Logger()
 
@@ -13,10 +16,33 @@ class Debug(commands.Cog):
 
     @commands.slash_command(name='sql', description='log sql data')
     async def get_sql(self, ctx: discord.ApplicationContext, text: str) -> None:
-        vals = db.select_from_unsafe(text)
+        vals = await db.select_from_unsafe(text)
         logger.info(vals)
         await ctx.respond("Check logs for output")
 
+    @commands.slash_command(name='sql_stats', description='log sql statement calls and latencies')
+    async def get_sql_stats(self, ctx: discord.ApplicationContext) -> None:
+        for (name, calls) in db.statement_calls.most_common():
+            logger.info(f"{name}: {calls} calls")
+        for (key, stats) in sorted(db.query_stats.items(), key=lambda item: -item[1].execute.total):
+            logger.info(f"{key[:100]}: connect {stats.connect.summary()}, " +
+                        f"execute {stats.execute.summary()}, fetch {stats.fetch.summary()}, " +
+                        f"{stats.rows} rows")
+        await ctx.respond("Check logs for output")
+
+    @commands.slash_command(name='cache_stats', description='log cache hit/miss counts')
+    async def get_cache_stats(self, ctx: discord.ApplicationContext) -> None:
+        for cache in metrics.CACHES:
+            logger.info(cache.summary())
+        logger.info(role_changes.summary())
+        await ctx.respond("Check logs for output")
+
+    @commands.slash_command(name='router_stats', description='log message handler latencies')
+    async def get_router_stats(self, ctx: discord.ApplicationContext) -> None:
+        for route in router.routes.values():
+            logger.info(f"{route.name}: {route.timing.summary()}")
+        await ctx.respond("Check logs for output")
+
     @commands.slash_command(name='sync', description="Sync commands")
     async def sync(self, ctx: discord.ApplicationContext) -> None:
         await self.bot.sync_commands()
@@ -1,10 +1,14 @@
 import discord
 import requests
 import json
-from discord.ext import commands, tasks
+import datetime as dt
+from discord.ext import commands
 
 import helpers.database as db
-from helpers.style import Emotes, TIME, RESET
+import helpers.settings as settings
+from helpers.broadcast import broadcast
+from helpers.scheduler import scheduler
+from helpers.style import Emotes
 from helpers.env import NINJA_API_KEY
 from helpers.logger import Logger
 
@@ -14,9 +18,7 @@ logger = Logger()
 class Facts(commands.Cog):
     def __init__(self, bot: discord.Bot) -> None:
         self.bot = bot
-        self.daily_fact.start()
-        self.sent_today = False
-        self.reset_fact.start()
+        scheduler.add("daily fact", self.daily_fact, lambda guild: guild.fact_channel is not None)
 
     @commands.slash_command(name='fact', description="Displays a random fact")
     async def send_fact(self, ctx: discord.ApplicationContext) -> None:
@@ -37,8 +39,10 @@ class Facts(commands.Cog):
     ) -> None:
         if not channel:
             channel = ctx.channel
-        db.single_void_SQL("UPDATE Guilds SET FactChannelID=%s WHERE ID=%s",
-                           (channel.id, ctx.guild_id))
+        await db.single_void_SQL("UPDATE Guilds SET FactChannelID=%s WHERE ID=%s",
+                                 (channel.id, ctx.guild_id))
+        settings.cache.set_fact_channel(ctx.guild_id, channel.id)
+        await settings.publish(["settings"], ctx.guild_id)
         await ctx.respond(
             f"Facts channel set to {channel.mention} {Emotes.DRINKING}",
             ephemeral=True
@@ -51,40 +55,39 @@ class Facts(commands.Cog):
     )
     @discord.commands.default_permissions(manage_guild=True)
     async def toggle_facts(self, ctx: discord.ApplicationContext) -> None:
-        db.single_void_SQL(
+        await db.single_void_SQL(
             "UPDATE Guilds SET FactChannelID=NULL WHERE ID=%s", (ctx.guild_id,))
+        settings.cache.set_fact_channel(ctx.guild_id, None)
+        await settings.publish(["settings"], ctx.guild_id)
         await ctx.respond(f"Stopping daily facts {Emotes.NOEMOTION}", ephemeral=True)
         logger.debug("Fact channel unset", member_id=ctx.user.id, guild_id=ctx.guild_id)
 
-    @tasks.loop(time=RESET)
-    async def reset_fact(self) -> None:
-        self.sent_today = False
-
-    @tasks.loop(time=TIME)
-    async def daily_fact(self) -> None:
+    async def daily_fact(self, guild_ids: list[int], day: dt.date) -> set[int]:
         """
-        Called daily to print facts to fact channel
+        Called daily (by the scheduler) to print facts to the fact channels of due guilds
+
+        Args:
+            guild_ids (list[int]): IDs of the guilds whose daily fact is due
+            day (dt.date): local day of the guilds
+
+        Returns:
+            set[int]: IDs of the guilds to retry
         """
-        if self.sent_today:
-            return
-        self.sent_today = True
-        logger.info("Starting daily fact loop")
-        guilds = db.single_sql("SELECT FactChannelID FROM Guilds")
+        cached = await settings.cache.all()
+        channels = {guild_id: cached[guild_id].fact_channel for guild_id in guild_ids
+                    if guild_id in cached and cached[guild_id].fact_channel}
+        if not channels:
+            return set()
+        logger.info(f"Starting daily fact of {day} for {len(guild_ids)} guilds")
         fact = self.get_fact()
-        for factID in guilds:
-            if factID[0]:
-                logger.debug("Attempting to send fact message", channel_id=factID[0])
-                try:
-                    msg = (("__Daily fact__\n" + fact) if fact else
-                           "Oh no, I can't think of any good facts right now. " +
-                           f"Maybe I will think of one later {Emotes.CRYING}")
-                    channel = await self.bot.fetch_channel(factID[0])
-                    if isinstance(channel, discord.abc.Messageable):
-                        await channel.send(msg)
-                    else:
-                        logger.info("Channel for daily fact not messageable", channel_id=factID[0])
-                except discord.errors.Forbidden:
-                    logger.info("Permission failure for sending fact message", channel_id=factID[0])
+        msg = (("__Daily fact__\n" + fact) if fact else
+               "Oh no, I can't think of any good facts right now. " +
+               f"Maybe I will think of one later {Emotes.CRYING}")
+        summary = await broadcast(self.bot, "daily fact", [
+            (channel_id, lambda channel: channel.send(msg))
+            for channel_id in channels.values() if channel_id])
+        return summary.retry({guild_id: {channel_id} for (guild_id, channel_id)
+                              in channels.items() if channel_id})
 
     @staticmethod
     def get_fact() -> str | None:
@@ -8,6 +8,7 @@ from characterai import PyAsyncCAI as PyCAI  # type: ignore[import]
 from helpers.style import Colours, Emotes
 from helpers.env import CAI_TOKEN, CAI_NIX_ID
 from helpers.logger import Logger
+from helpers.router import router
 
 logger = Logger()
 
@@ -15,6 +16,7 @@ logger = Logger()
 class Misc(commands.Cog):
     def __init__(self, bot: discord.Bot) -> None:
         self.bot = bot
+        router.add("respond", self.respond, self.mentioned, guild_only=False)
 
     @commands.slash_command(
         name='quote',
@@ -51,15 +53,15 @@ class Misc(commands.Cog):
         await ctx.interaction.response.send_message(embed=view.build_embed(), view=view)
         logger.info("Displaying short help", member_id=ctx.author.id, channel_id=ctx.channel_id)
 
-    @commands.Cog.listener("on_message")
+    async def mentioned(self, msg: discord.Message) -> bool:
+        return (self.bot.user is not None and self.bot.user.mentioned_in(msg)
+                and msg.reference is None)
+
     async def respond(self, msg: discord.Message) -> None:
         if self.bot.user is None:
             logger.error("Bot is offline")
             return
 
-        if not (self.bot.user.mentioned_in(msg) and msg.reference is None):
-            return
-
         prompt = re.sub(
             " @", " ", re.sub("@" + self.bot.user.name, "", msg.clean_content))
         logger.info("Generating AI response",
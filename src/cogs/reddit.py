@@ -1,8 +1,13 @@
+import datetime as dt
 import discord
-from discord.ext import commands, tasks
+import functools
+from discord.ext import commands
 
 import helpers.database as db
-from helpers.style import Emotes, Colours, TIME, RESET
+import helpers.settings as settings
+from helpers.broadcast import broadcast
+from helpers.scheduler import scheduler
+from helpers.style import Emotes, Colours
 import reddit.ui_kit as ui
 from reddit.interface import RedditInterface
 from helpers.logger import Logger
@@ -13,9 +18,7 @@ logger = Logger()
 class Reddit(commands.Cog):
     def __init__(self, bot: discord.Bot) -> None:
         self.bot = bot
-        self.daily_post.start()
-        self.sent_today = False
-        self.reset_reddit.start()
+        scheduler.add("daily reddit post", self.daily_post, lambda guild: bool(guild.subreddits))
 
     @commands.slash_command(
         name='reddit',
@@ -59,21 +62,20 @@ class Reddit(commands.Cog):
         if not await RedditInterface.valid_sub(sub):
             logger.warning(f"Subreddit {sub} is not valid", guild_id=ctx.guild_id)
             await ctx.respond(f"The subreddit {sub} is not available {Emotes.EVIL}")
-        elif (sub.lower(),) in db.single_sql(
-            "SELECT Subreddit FROM Subreddits WHERE GuildID=%s",
-            (ctx.guild_id,)
-        ):
+        elif sub.lower() in await self.subscriptions(ctx.guild_id):
             logger.warning(f"Subreddit {sub} was already subscribed to",
                            guild_id=ctx.guild_id, channel_id=channel.id)
             await ctx.respond(f"This server is already subscribed to {sub} {Emotes.SUPRISE}")
         else:
             logger.info(f"Subreddit {sub} got subscribed to",
                         guild_id=ctx.guild_id, channel_id=channel.id)
-            db.single_void_SQL(
+            await db.single_void_SQL(
                 "INSERT INTO Subreddits (GuildID, Subreddit, SubredditChannelID) " +
                 "VALUES (%s, %s, %s)",
                 (ctx.guild_id, sub.lower(),
                  channel.id))
+            settings.cache.subscribe(ctx.guild_id, sub.lower(), channel.id)
+            await settings.publish(["settings"], ctx.guild_id)
             await ctx.respond(f"This server is now subscribed to {sub} {Emotes.HUG}")
 
     @commands.slash_command(name='unsubscribe',
@@ -84,24 +86,22 @@ class Reddit(commands.Cog):
         if not sub:
             await self.get_subs(ctx)
             return
-        if (sub.lower(),) not in db.single_sql(
-            "SELECT Subreddit FROM Subreddits WHERE GuildID=%s",
-            (ctx.guild_id,)
-        ):
+        if sub.lower() not in await self.subscriptions(ctx.guild_id):
             logger.warning(f"Subreddit {sub} was never subscribed to", guild_id=ctx.guild_id)
             await ctx.respond(f"This server is not subscribed to r/{sub} {Emotes.SUPRISE}")
         else:
             logger.info(f"Subreddit {sub} was unsubscribed from",
                         guild_id=ctx.guild_id, channel_id=ctx.channel_id)
-            db.single_void_SQL(
-                "DELETE FROM Subreddits WHERE GuildID=%s AND Subreddit=%s ", (ctx.guild_id, sub))
+            await db.single_void_SQL("DELETE FROM Subreddits WHERE GuildID=%s AND Subreddit=%s ",
+                                     (ctx.guild_id, sub.lower()))
+            settings.cache.unsubscribe(ctx.guild_id, sub.lower())
+            await settings.publish(["settings"], ctx.guild_id)
             await ctx.respond(f"This server is now unsubscribed from r/{sub} {Emotes.SNEAKY}")
 
     @commands.slash_command(name='subscriptions',
                             description="Get a list of the subscriptions of the server")
     async def get_subs(self, ctx: discord.ApplicationContext) -> None:
-        subscriptions = db.single_sql(
-            "SELECT Subreddit FROM Subreddits WHERE GuildID=%s", (ctx.guild_id,))
+        subscriptions = await self.subscriptions(ctx.guild_id)
         logger.info("The list of subscripted subreddits was requested",
                     guild_id=ctx.guild_id, channel_id=ctx.channel_id)
         sub_command = self.bot.get_application_command("subscribe")
@@ -111,40 +111,66 @@ class Reddit(commands.Cog):
         desc = "You have not subscribed to any subreddits yet\nGet started with {0}!".format(
             sub_command.mention)
         if subscriptions:
-            desc = "\n".join(["> " + sub[0] for sub in subscriptions])
+            desc = "\n".join(["> " + sub for sub in subscriptions])
         embed = discord.Embed(
             title="Subscriptions",
             description=desc,
             colour=Colours.PRIMARY)
         await ctx.respond(embed=embed)
 
-    @tasks.loop(time=RESET)
-    async def reset_reddit(self) -> None:
-        self.sent_today = False
+    @staticmethod
+    async def subscriptions(guild_id: int | None) -> dict[str, int]:
+        """
+        Gets the (cached) subscriptions of a guild
+
+        Args:
+            guild_id (int | None): ID of the guild
 
-    @tasks.loop(time=TIME)
-    async def daily_post(self) -> None:
+        Returns:
+            dict[str, int]: channel ID of each subscribed subreddit
         """
-        Called daily to print random post from subbed sub to linked discord channel
+        guild_settings = await settings.cache.get(guild_id) if guild_id else None
+        return guild_settings.subreddits if guild_settings else {}
+
+    async def daily_post(self, guild_ids: list[int], day: dt.date) -> set[int]:
         """
-        if self.sent_today:
-            return
-        self.sent_today = True
-        logger.info("Starting daily reddit loop")
-        subs = db.single_sql("SELECT GuildID, Subreddit, SubredditChannelID FROM Subreddits")
-        for entry in subs:
-            logger.info(f"Attempting to send reddit daily post <subreddit: {entry[1]}>",
-                        guild_id=entry[0], channel_id=entry[2])
-            try:
-                post = await RedditInterface.single_post(entry[1], "day")
-                channel = await self.bot.fetch_channel(entry[2])
-                if not isinstance(channel, discord.abc.Messageable):
-                    logger.error("reddit daily post channel is not sendable")
-                    continue
-                await channel.send("__Daily post__\n" + post.text, files=post.img)
-            except discord.errors.Forbidden:
-                logger.info(f"Permission failure for daily reddit post <subreddit: {entry[1]}>",
-                            guild_id=entry[0], channel_id=entry[2])
+        Called daily (by the scheduler) to print random post from subbed sub to linked
+        discord channel of due guilds
+
+        Args:
+            guild_ids (list[int]): IDs of the guilds whose daily posts are due
+            day (dt.date): local day of the guilds
+
+        Returns:
+            set[int]: IDs of the guilds to retry
+        """
+        cached = await settings.cache.all()
+        subs = [(guild_id, subreddit, channel_id) for guild_id in guild_ids
+                if guild_id in cached
+                for (subreddit, channel_id) in cached[guild_id].subreddits.items()]
+        if not subs:
+            return set()
+        logger.info(f"Starting daily reddit posts of {day} for {len(subs)} subscriptions")
+        summary = await broadcast(self.bot, "daily reddit post", [
+            (channel_id, functools.partial(self.send_daily_post, subreddit))
+            for (_, subreddit, channel_id) in subs])
+        channels: dict[int, set[int]] = {}
+        for (guild_id, _, channel_id) in subs:
+            channels.setdefault(guild_id, set()).add(channel_id)
+        return summary.retry(channels)
+
+    @staticmethod
+    async def send_daily_post(subreddit: str, channel: discord.abc.Messageable) -> None:
+        """
+        Sends the daily post of a subscription
+
+        Args:
+            subreddit (str): Subscribed subreddit
+            channel (discord.abc.Messageable): Channel subscribed in
+        """
+        logger.info(f"Attempting to send reddit daily post <subreddit: {subreddit}>")
+        post = await RedditInterface.single_post(subreddit, "day")
+        await channel.send("__Daily post__\n" + post.text, files=post.img)
 
 
 def setup(bot: discord.Bot) -> None:
@@ -3,6 +3,7 @@ import typing
 from discord.ext import commands
 
 from helpers.logger import Logger
+from helpers.router import router
 from helpers.style import Emotes, Colours
 
 from trivia.interface import TriviaGame
@@ -29,6 +30,7 @@ class Trivia(commands.Cog):
     def __init__(self, bot: discord.Bot) -> None:
         self.bot = bot
         self.active_views: typing.Dict[int, TriviaView] = {}
+        router.add("trivia", self.on_guess, self.trivia_channel)
 
     @commands.slash_command(
         name='trivia',
@@ -74,16 +76,13 @@ class Trivia(commands.Cog):
         else:
             await ctx.send(text, view=view)
 
-    @commands.Cog.listener("on_message")
+    async def trivia_channel(self, msg: discord.Message) -> bool:
+        return msg.channel.id in self.active_views
+
     async def on_guess(self, msg: discord.Message) -> None:
-        if isinstance(msg.channel, discord.abc.PrivateChannel):
-            logger.info("on_guess activated in PrivateChannel", channel_id=msg.channel.id)
-            return
-        if self.bot.user is None:
-            logger.error("Bot is offline")
-            return
-        if msg.author.id != self.bot.user.id and msg.channel.id in self.active_views.keys():
-            await self.active_views[msg.channel.id].handle_guess(msg)
+        view = self.active_views.get(msg.channel.id)
+        if view is not None:  # game may have ended since the message was routed
+            await view.handle_guess(msg)
 
     @commands.slash_command(name='stop_trivia',
                             description='stops the in-progress trivia game in this channel')
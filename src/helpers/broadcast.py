@@ -0,0 +1,156 @@
+import asyncio
+import time
+import traceback
+import typing
+from dataclasses import dataclass, field
+
+import discord
+
+from helpers.logger import Logger
+
+logger = Logger()
+
+CONCURRENCY = 10  # channels sent to at the same time
+SENDS_PER_SECOND = 40  # pace of sends, under Discord's global limit of 50 requests/s
+
+Channel = discord.abc.GuildChannel
+Send = typing.Callable[[discord.abc.Messageable], typing.Awaitable[typing.Any]]
+Target = tuple[int, Send]  # channel ID, sends the message to the resolved channel
+
+
+@dataclass
+class Summary:
+    """Outcome of a broadcast"""
+    name: str
+    sent: int = 0
+    forbidden: int = 0
+    missing: int = 0
+    failed: int = 0
+    duration: float = 0
+    failed_channels: set[int] = field(default_factory=set)  # nothing sent, worth retrying
+
+    def retry(self, channels: dict[int, set[int]]) -> set[int]:
+        """Gets the guilds worth retrying, those whose every channel failed
+
+        Guilds that got some of their messages are not retried, so none is sent twice.
+
+        Args:
+            channels (dict[int, set[int]]): channel IDs sent to of each guild
+
+        Returns:
+            set[int]: IDs of the guilds to retry
+        """
+        return {guild_id for (guild_id, guild_channels) in channels.items()
+                if guild_channels and guild_channels <= self.failed_channels}
+
+    def __str__(self) -> str:
+        return (f"{self.name}: {self.sent} sent, {self.forbidden} forbidden, " +
+                f"{self.missing} missing, {self.failed} failed in {self.duration:.1f}s")
+
+
+class _Pacer:
+    """Spaces calls out to a rate
+
+    Args:
+        rate (float): calls per second
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        """Waits for the next free slot"""
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def _resolve(bot: discord.Bot, channel_id: int) -> discord.abc.Messageable | None:
+    """Gets a guild text channel from the gateway cache, fetching it only if not cached
+
+    Args:
+        bot (discord.Bot): the bot
+        channel_id (int): ID of the channel
+
+    Raises:
+        discord.HTTPException: Raised when fetching the channel failed
+
+    Returns:
+        discord.abc.Messageable | None: the channel, None if it is not a guild text channel
+    """
+    channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+    if isinstance(channel, discord.abc.Messageable) and isinstance(channel, Channel):
+        return channel
+    return None
+
+
+async def broadcast(bot: discord.Bot, name: str, targets: list[Target]) -> Summary:
+    """Sends to many channels with bounded concurrency, then logs a summary
+
+    Sends to the same channel (one rate limit bucket) are made one after another, and
+    all sends are paced to stay under the global rate limit. A failing target does not
+    stop the others.
+
+    Args:
+        bot (discord.Bot): the bot
+        name (str): name of the broadcast (for logging)
+        targets (list[Target]): channel IDs and what to send to each
+
+    Returns:
+        Summary: counts of the outcomes
+    """
+    summary = Summary(name)
+    start = time.perf_counter()
+    by_channel: dict[int, list[Send]] = {}
+    for (channel_id, send) in targets:
+        by_channel.setdefault(channel_id, []).append(send)
+    slots = asyncio.Semaphore(CONCURRENCY)
+    pacer = _Pacer(SENDS_PER_SECOND)
+
+    async def deliver(channel_id: int, sends: list[Send]) -> None:
+        async with slots:
+            try:
+                channel = await _resolve(bot, channel_id)
+            except discord.Forbidden:
+                summary.forbidden += len(sends)
+                return
+            except discord.NotFound:
+                summary.missing += len(sends)
+                return
+            except discord.HTTPException as err:
+                logger.error(f"Failed to get {name} channel: {err}", channel_id=channel_id)
+                summary.failed += len(sends)
+                summary.failed_channels.add(channel_id)
+                return
+            if channel is None:
+                logger.info(f"{name} channel is not a guild text channel", channel_id=channel_id)
+                summary.missing += len(sends)
+                return
+            (sent, failed) = (0, False)
+            for send in sends:
+                await pacer.wait()
+                try:
+                    await send(channel)
+                    sent += 1
+                except discord.Forbidden:
+                    logger.info(f"Permission failure for {name}", channel_id=channel_id)
+                    summary.forbidden += 1
+                except discord.NotFound:
+                    summary.missing += 1
+                except Exception:  # e.g. a failing API behind the message, skip the target
+                    logger.error(f"Failed {name} send\n{traceback.format_exc()}",
+                                 channel_id=channel_id)
+                    summary.failed += 1
+                    failed = True
+            summary.sent += sent
+            if failed and not sent:
+                summary.failed_channels.add(channel_id)
+
+    await asyncio.gather(*[deliver(channel_id, sends)
+                           for (channel_id, sends) in by_channel.items()])
+    summary.duration = time.perf_counter() - start
+    logger.info(str(summary))
+    return summary
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import psycopg2
+import sqlite3
+import tempfile
+import traceback
+from dataclasses import dataclass
+
+import helpers.database as db
+from helpers.env import COUNTING_JOURNAL, COUNTING_SHARED
+from helpers.logger import Logger
+
+logger = Logger()
+
+FLUSH_INTERVAL = 5  # seconds a changed count may be held in memory only
+BIGINT_MAX = 2 ** 63 - 1
+JOURNAL = COUNTING_JOURNAL or os.path.join(tempfile.gettempdir(), "nix-counting.journal")
+
+Row = tuple[int, int | None, int, int]  # CurrentCount, LastCounterID, HighScore, ChannelID
+
+
+class NotCounting(Exception):
+    pass
+
+
+@dataclass
+class ChannelCount:
+    """Counting state of a channel"""
+    count: int = 0
+    last_counter: int | None = None
+    high_score: int = 0
+
+
+def _check(count: int, last_counter: int | None, author_id: int, number: int) -> str | None:
+    """Checks a number against the state of its channel
+
+    Args:
+        count (int): current count of the channel
+        last_counter (int | None): ID of the user who counted last
+        author_id (int): ID of the user counting
+        number (int): number counted
+
+    Returns:
+        str | None: why the count failed, None if it is correct
+    """
+    if number != count + 1:
+        return "Wrong number"
+    if author_id == last_counter:
+        return "Same user entered two numbers"
+    return None
+
+
+class CountingEngine:
+    """Authoritative in-memory counting state, written back to the database behind the game
+
+    Channels are loaded on first use. Changes are written back in one batch at most every
+    FLUSH_INTERVAL, and failed counts straight away. Each batch is journaled to disk until
+    the database has it, so a crash loses at most the last interval (and nothing while the
+    database is down). At shutdown the unwritten changes are journaled and replayed.
+    This only holds if COUNTING_JOURNAL is on storage that outlives the process (e.g. a
+    mounted volume), the default temporary directory is lost with the machine.
+
+    When several processes serve the same guilds (COUNTING_SHARED, PostgreSQL only) the
+    database is the authority instead, each count is one conditional statement.
+    """
+
+    def __init__(self) -> None:
+        self.shared = bool(COUNTING_SHARED) and not db.is_sqlite()
+        self._channels: dict[int, ChannelCount] = {}
+        self._dirty: set[int] = set()
+        self._timer: asyncio.Task[None] | None = None
+        self._urgent: set[asyncio.Task[None]] = set()
+        self._flush_lock = asyncio.Lock()
+        if not self.shared and not COUNTING_JOURNAL:
+            logger.warning(f"COUNTING_JOURNAL is not set, journaling counts to {JOURNAL}. " +
+                           "Unless that survives a restart, a crash loses the counts of the " +
+                           f"last {FLUSH_INTERVAL}s (or more while the database is down)")
+
+    async def _load(self, channel_id: int) -> ChannelCount:
+        state = self._channels.get(channel_id)
+        if state is None:
+            rows = await db.named_sql("counting_load", (channel_id,))
+            if not rows:
+                raise NotCounting(f"Channel {channel_id} is not a counting channel")
+            state = self._channels.setdefault(channel_id, ChannelCount(*rows[0]))
+        return state
+
+    async def count(self, channel_id: int, author_id: int, number: int) -> str | None:
+        """Plays a number in a channel, resetting the count if it is wrong
+
+        Args:
+            channel_id (int): ID of the channel
+            author_id (int): ID of the user counting
+            number (int): number counted
+
+        Raises:
+            NotCounting: Raised when the channel is not a counting channel
+
+        Returns:
+            str | None: why the count failed, None if it was correct
+        """
+        if self.shared:
+            played = number if number <= BIGINT_MAX else -1  # too big to be the next count
+            rows = await db.named_sql("counting_play", (
+                played, author_id, channel_id, played, author_id, played, channel_id))
+            if not rows:
+                raise NotCounting(f"Channel {channel_id} is not a counting channel")
+            return _check(rows[0][0], rows[0][1], author_id, number)
+        state = await self._load(channel_id)
+        err_txt = _check(state.count, state.last_counter, author_id, number)
+        if err_txt:
+            state.count = 0
+            state.last_counter = None
+        else:
+            state.count = number
+            state.last_counter = author_id
+            state.high_score = max(state.high_score, number)
+        self._changed(channel_id, urgent=bool(err_txt))
+        return err_txt
+
+    def remove(self, channel_id: int) -> None:
+        """Forgets a channel that stopped counting (or was deleted)
+
+        Args:
+            channel_id (int): ID of the channel
+        """
+        self._channels.pop(channel_id, None)
+        self._dirty.discard(channel_id)
+
+    def _changed(self, channel_id: int, urgent: bool = False) -> None:
+        self._dirty.add(channel_id)
+        if urgent:
+            task = asyncio.create_task(self.flush())
+            self._urgent.add(task)
+            task.add_done_callback(self._urgent.discard)
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        self._timer = None
+        await self.flush()
+
+    def _take(self) -> list[Row]:
+        rows = [(state.count, state.last_counter, state.high_score, channel_id)
+                for (channel_id, state) in self._channels.items() if channel_id in self._dirty]
+        self._dirty.clear()
+        return rows
+
+    async def flush(self) -> None:
+        """Writes every changed channel back to the database in one transaction
+
+        The journal is written off the event loop (it syncs to disk). If the write back fails
+        the channels are marked changed again, to be retried by the next flush.
+        """
+        async with self._flush_lock:
+            rows = self._take()
+            if not rows:
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, _write_journal, rows)
+                journaled = True
+            except OSError as err:  # still worth writing back, only crash safety is lost
+                logger.error(f"Failed to journal {len(rows)} counting channels: {err}")
+                journaled = False
+            try:
+                async with db.transaction() as tx:
+                    for row in rows:
+                        await tx.named_void_sql("counting_save", row)
+            except Exception:  # whatever failed, the rows must not be lost
+                logger.error(f"Failed to write back {len(rows)} counting channels, retrying\n" +
+                             traceback.format_exc())
+                for (_, _, _, channel_id) in rows:
+                    if channel_id in self._channels:
+                        self._changed(channel_id)
+                return
+            if journaled:
+                await loop.run_in_executor(None, os.remove, JOURNAL)
+
+    def close(self) -> None:
+        """Journals the changes not yet written back (from outside the event loop)"""
+        rows = self._take()
+        if rows:
+            _write_journal(rows)
+
+
+def _write_journal(rows: list[Row]) -> None:
+    """Replaces the journal with the given rows, keeping any not yet written back
+
+    Args:
+        rows (list[Row]): rows to journal
+    """
+    pending = {row[3]: row for row in _read_journal()} | {row[3]: row for row in rows}
+    with open(JOURNAL + ".tmp", "w") as file:
+        json.dump(list(pending.values()), file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(JOURNAL + ".tmp", JOURNAL)
+
+
+def _read_journal() -> list[Row]:
+    if not os.path.exists(JOURNAL):
+        return []
+    with open(JOURNAL) as file:
+        return [(count, last, high, channel) for (count, last, high, channel) in json.load(file)]
+
+
+def replay_journal() -> None:
+    """
+    Writes back the counts left in the journal by a crash or shutdown, blocking.
+    Called at startup (before the bot runs) and at shutdown
+    """
+    rows = _read_journal()
+    if not rows:
+        return
+    logger.info(f"Replaying {len(rows)} journaled counting channels")
+    query = db.STATEMENTS["counting_save"].query
+    try:
+        con = db.connect_sync()
+        try:
+            for row in rows:
+                db.run_sync(con, query, row)
+            con.commit()
+        finally:
+            con.close()
+    except (psycopg2.Error, sqlite3.Error) as err:
+        logger.error(f"Failed to replay counting journal, keeping it for next time: {err}")
+        return
+    os.remove(JOURNAL)
+
+
+engine = CountingEngine()
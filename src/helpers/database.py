@@ -1,88 +1,920 @@
+import aiosqlite
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2.errors import UniqueViolation
+import re
+import sqlite3
+import time
 import typing
 import traceback
 
-from helpers.env import DATABASE_URL
+import helpers.testdb as testdb
+from helpers.env import DATABASE_URL, DATABASE_POOL_SIZE, SLOW_QUERY_MS
 from helpers.logger import Logger
+from helpers.metrics import Histogram, caller
 
 logger = Logger()
 
+POOL_SIZE = int(DATABASE_POOL_SIZE) if DATABASE_POOL_SIZE else 10
+IDLE_CHECK = 30  # seconds a pooled connection may idle before it is pinged on checkout
+LISTEN_RETRY = 5  # seconds between attempts to reopen a lost notification connection
+SQLITE_SCHEME = "sqlite:///"  # e.g. sqlite:///nix.db (relative) or sqlite:////data/nix.db
+SQLITE_MIN_VERSION = (3, 35)  # RETURNING and ALTER TABLE ... DROP COLUMN
+SLOW_QUERY = (int(SLOW_QUERY_MS) if SLOW_QUERY_MS else 100) / 1000  # seconds
+
+T = typing.TypeVar("T")
+Rows = list[tuple[typing.Any, ...]]
+
 
 class KeyViolation(Exception):
     pass
 
 
-def select_from_unsafe(table_name: str) -> typing.List[typing.Tuple[typing.Any, ...]]:
-    """logs select from table. ONLY FOR TESTING
+def is_sqlite(url: str | None = DATABASE_URL) -> bool:
+    """Checks whether a database URL selects the embedded SQLite backend
 
     Args:
-        table_name (str): table to select from
+        url (str | None, optional): database URL. Defaults to DATABASE_URL.
 
     Returns:
-        typing.Optional[typing.Any]: returned values
+        bool: True for sqlite:/// URLs, False for PostgreSQL
     """
-    con = psycopg2.connect(DATABASE_URL)
-    cur = con.cursor()
-    cur.execute(f'SELECT * FROM public.{table_name}')
-    val = cur.fetchall()
-    con.commit()
-    cur.close()
-    con.close()
+    return bool(url) and typing.cast(str, url).startswith(SQLITE_SCHEME)
+
+
+def _check_sqlite_version() -> None:
+    """Fails fast when the linked SQLite library lacks syntax the bot and migrations use
+
+    Raises:
+        RuntimeError: Raised when SQLite is older than SQLITE_MIN_VERSION
+    """
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise RuntimeError(
+            f"SQLite {sqlite3.sqlite_version} is too old, the SQLite backend needs " +
+            ".".join(str(part) for part in SQLITE_MIN_VERSION) + " or newer")
+
+
+# Postgres-only syntax used by the bot and the SQLite equivalent, this is the only place
+# dialect differences are handled (besides statements registered with a sqlite variant)
+_SQLITE_REWRITES = [
+    (re.compile(r"\bstring_agg\(", re.IGNORECASE), "group_concat("),
+    (re.compile(r"\b(\w+)::varchar\b", re.IGNORECASE), r"CAST(\1 AS TEXT)"),
+    (re.compile(r"::bigint\b", re.IGNORECASE), ""),
+    (re.compile(r"\bGREATEST\(", re.IGNORECASE), "MAX("),
+    (re.compile(r"\s+FOR UPDATE(\s+SKIP LOCKED)?\b", re.IGNORECASE), ""),
+    (re.compile(r"\bCONCURRENTLY\s+", re.IGNORECASE), ""),
+    (re.compile(r"\bpublic\.", re.IGNORECASE), ""),
+    (re.compile(r"\s+WITH\s*\(fillfactor=\d+\)", re.IGNORECASE), ""),
+]
+_PLACEHOLDER = re.compile(r"=\s*ANY\(%s\)|%s", re.IGNORECASE)
+
+
+def sqlite_query(
+    query: str,
+    values: typing.Sequence[typing.Any] | None
+) -> list[tuple[str, list[typing.Any]]]:
+    """Translates a Postgres style query (%s placeholders) to SQLite
+
+    Array parameters (= ANY(%s)) are expanded to IN lists, and ;-separated queries are
+    split into separate statements (each taking its share of the values).
+
+    Args:
+        query (str): query in the Postgres dialect
+        values (typing.Sequence[typing.Any] | None): values for the placeholders
+
+    Returns:
+        list[tuple[str, list[typing.Any]]]: SQLite statements and their values
+    """
+    for (pattern, replacement) in _SQLITE_REWRITES:
+        query = pattern.sub(replacement, query)
+    remaining = list(values or [])
+    statements = []
+    for part in [part for part in query.split(";") if part.strip()]:
+        params: list[typing.Any] = []
+
+        def placeholder(match: re.Match[str]) -> str:
+            value = remaining.pop(0)
+            if match.group(0) == "%s":
+                params.append(value)
+                return "?"
+            params.extend(value)
+            return "IN (" + ", ".join(["?"] * len(value)) + ")"
+
+        statements.append((_PLACEHOLDER.sub(placeholder, part), params))
+    return statements
+
+
+class Statement:
+    """Named SQL statement, prepared server-side once per pooled connection
+
+    Args:
+        name (str): name the statement is registered and prepared under
+        query (str): SQL query using %s placeholders (as with single_sql)
+        sqlite (str | None, optional): SQLite variant, if the query cannot be translated
+    """
+
+    def __init__(self, name: str, query: str, sqlite: str | None = None) -> None:
+        self.name = name
+        self.query = query
+        self.sqlite = sqlite or query
+        params = query.split("%s")
+        self.params = len(params) - 1
+        self.prepare = f"PREPARE {name} AS " + "".join(
+            [part + (f"${i + 1}" if i < len(params) - 1 else "") for i, part in enumerate(params)]
+        )
+        self.execute = f"EXECUTE {name}" + (
+            " (" + ", ".join(["%s"] * (len(params) - 1)) + ")" if len(params) > 1 else "")
+
+
+STATEMENTS: dict[str, Statement] = {}
+statement_calls: collections.Counter[str] = collections.Counter()
+
+
+def register(name: str, query: str, sqlite: str | None = None) -> None:
+    """Adds a named statement to the registry, callable with named_sql/named_void_sql
+
+    Args:
+        name (str): name of the statement
+        query (str): SQL query using %s placeholders
+        sqlite (str | None, optional): SQLite variant of the query (may be several
+            ;-separated statements). Defaults to translating query.
+    """
+    if name in STATEMENTS:
+        raise ValueError(f"Statement {name} is already registered")
+    STATEMENTS[name] = Statement(name, query, sqlite)
+
+
+register("counting_load",
+         "SELECT CurrentCount, LastCounterID, HighScore FROM Counting WHERE ChannelID=%s")
+register("counting_save",
+         "UPDATE Counting SET CurrentCount=%s, LastCounterID=%s, HighScore=%s WHERE ChannelID=%s")
+# plays a count (number, author, channel, number, author, number, channel) in one statement,
+# the row lock orders processes and the previous state is returned to tell if it counted
+register("counting_play",
+         "WITH old AS (SELECT CurrentCount, LastCounterID, " +
+         "CurrentCount = %s::bigint - 1 AND LastCounterID IS DISTINCT FROM %s::bigint AS ok " +
+         "FROM Counting WHERE ChannelID=%s FOR UPDATE), " +
+         "new AS (UPDATE Counting SET CurrentCount=CASE WHEN old.ok THEN %s::bigint ELSE 0 END, " +
+         "LastCounterID=CASE WHEN old.ok THEN %s::bigint END, " +
+         "HighScore=CASE WHEN old.ok THEN GREATEST(Counting.HighScore, %s::bigint) " +
+         "ELSE Counting.HighScore END FROM old WHERE Counting.ChannelID=%s) " +
+         "SELECT CurrentCount, LastCounterID FROM old")
+# claims due jobs (lease end, now, max attempts, batch size), rows locked by another worker
+# are skipped, and the lease makes the jobs of a worker that died due again once it ends
+register("daily_job_claim",
+         "UPDATE DailyJobs SET RunAt=%s, Attempts=Attempts + 1 " +
+         "WHERE (GuildID, Feature, Day) IN (SELECT GuildID, Feature, Day FROM DailyJobs " +
+         "WHERE NOT Done AND RunAt <= %s AND Attempts < %s ORDER BY RunAt LIMIT %s " +
+         "FOR UPDATE SKIP LOCKED) RETURNING GuildID, Feature, Day, Attempts")
+register("daily_job_done",
+         "UPDATE DailyJobs SET Done=TRUE WHERE Feature=%s AND Day=%s AND GuildID = ANY(%s)")
+# backs off exponentially (now, back-off, feature, day, guild IDs)
+register("daily_job_retry",
+         "UPDATE DailyJobs SET RunAt=%s::bigint + %s::bigint * (1::bigint << (Attempts - 1)) " +
+         "WHERE Feature=%s AND Day=%s AND GuildID = ANY(%s)")
+# finished or not, e.g. a last attempt whose worker died is never claimed again
+register("daily_job_prune", "DELETE FROM DailyJobs WHERE RunAt < %s")
+register("chain_messages",
+         "SELECT WatchedChannelID, ResponseChannelID, Message FROM MessageChain WHERE GuildID=%s")
+register("chain_user",
+         "INSERT INTO ChainedUsers VALUES (%s, %s, %s) ON CONFLICT DO NOTHING RETURNING UserID")
+register("role_channel_rules", "SELECT RoleID, ToAdd FROM RoleChannel WHERE ChannelID=%s")
+register("react_roles", "SELECT Emoji, RoleID FROM ReactMessages WHERE MessageID=%s")
+register("guild_cleanup", "DELETE FROM Guilds WHERE ID=%s")
+register("channel_cleanup",
+         "WITH s AS (DELETE FROM Subreddits WHERE SubredditChannelID = ANY(%s)), " +
+         "m AS (DELETE FROM MessageChain WHERE WatchedChannelID = ANY(%s) " +
+         "OR ResponseChannelID = ANY(%s)), " +
+         "r AS (DELETE FROM RoleChannel WHERE ChannelID = ANY(%s)) " +
+         "DELETE FROM Counting WHERE ChannelID = ANY(%s)",
+         sqlite="DELETE FROM Subreddits WHERE SubredditChannelID = ANY(%s); " +
+         "DELETE FROM MessageChain WHERE WatchedChannelID = ANY(%s) " +
+         "OR ResponseChannelID = ANY(%s); DELETE FROM RoleChannel WHERE ChannelID = ANY(%s); " +
+         "DELETE FROM Counting WHERE ChannelID = ANY(%s)")
+register("member_cleanup",
+         "WITH b AS (DELETE FROM Birthdays WHERE GuildID=%s AND UserID=%s) " +
+         "DELETE FROM ChainedUsers WHERE GuildID=%s AND UserID=%s",
+         sqlite="DELETE FROM Birthdays WHERE GuildID=%s AND UserID=%s; " +
+         "DELETE FROM ChainedUsers WHERE GuildID=%s AND UserID=%s")
+
+Command = tuple[str | Statement, tuple[typing.Any, ...] | None]
+Runner = typing.Callable[[Command, bool], typing.Awaitable[Rows]]
+
+
+class QueryStats:
+    """Latency histograms (in seconds) and rows returned for one statement"""
+
+    def __init__(self) -> None:
+        self.connect = Histogram()
+        self.execute = Histogram()
+        self.fetch = Histogram()
+        self.rows = 0
+
+
+query_stats: collections.defaultdict[str, QueryStats] = collections.defaultdict(QueryStats)
+
+
+class Timing:
+    """Connect, execute and fetch times of one unit of work, filled in as it runs
+
+    Connect covers waiting for and checking out a connection. Execute includes the commit
+    for the last command of a unit, fetch is only measured for commands that return rows.
+    """
+
+    def __init__(self) -> None:
+        self.connect: float | None = None
+        self.commands: list[tuple[str, float, float | None, int]] = []
+
+    def command(self, query: str | Statement, execute: float, fetch: float | None,
+                rows: int) -> None:
+        """Records the times of a single command
+
+        Args:
+            query (str | Statement): query or named statement that ran
+            execute (float): seconds spent executing
+            fetch (float | None): seconds spent fetching rows (None if not fetched)
+            rows (int): number of rows returned
+        """
+        key = query.name if isinstance(query, Statement) else " ".join(query.split())
+        self.commands.append((key, execute, fetch, rows))
+
+    def record(self) -> None:
+        """Adds the recorded times to query_stats (connect time goes to the first command)
+        and logs any command slower than SLOW_QUERY_MS along with its calling cog and guild
+        """
+        for (key, execute, fetch, rows) in self.commands:
+            stats = query_stats[key]
+            total = execute + (fetch or 0) + (self.connect or 0)
+            if self.connect is not None:
+                stats.connect.add(self.connect)
+            stats.execute.add(execute)
+            if fetch is not None:
+                stats.fetch.add(fetch)
+            stats.rows += rows
+            if total > SLOW_QUERY:
+                (call_class, guild_id) = caller(__name__)
+                logger.warning(
+                    f"Slow query from {call_class} ({total * 1000:.0f}ms: connect " +
+                    f"{(self.connect or 0) * 1000:.0f}ms, execute {execute * 1000:.0f}ms, " +
+                    f"fetch {(fetch or 0) * 1000:.0f}ms, {rows} rows): {key[:200]}",
+                    guild_id=guild_id)
+            self.connect = None
+        self.commands.clear()
+
+
+class Transaction:
+    """Unit of work running several statements on one connection and transaction
+
+    Obtained from db.transaction(), mirrors the module level query functions.
+    Note that after an error the transaction is aborted, so prefer ON CONFLICT to KeyViolation.
+    """
+
+    def __init__(self, run: Runner, timing: Timing) -> None:
+        self._run = run
+        self._timing = timing
+
+    async def _timed(self, command: Command, fetch: bool) -> Rows:
+        try:
+            return await _guard(self._run(command, fetch))
+        finally:
+            self._timing.record()
+
+    async def single_sql(self, query: str, values: tuple[typing.Any, ...] = (None,)) -> Rows:
+        """See db.single_sql"""
+        return await self._timed((query, values if values != (None,) else None), True)
+
+    async def single_void_SQL(self, query: str, values: tuple[typing.Any, ...] = (None,)) -> None:
+        """See db.single_void_SQL"""
+        await self._timed((query, values if values != (None,) else None), False)
+
+    async def named_sql(self, name: str, values: tuple[typing.Any, ...] = ()) -> Rows:
+        """See db.named_sql"""
+        return await self._timed((_lookup(name), values or None), True)
+
+    async def named_void_sql(self, name: str, values: tuple[typing.Any, ...] = ()) -> None:
+        """See db.named_void_sql"""
+        await self._timed((_lookup(name), values or None), False)
+
+
+class _Connection(psycopg2.extensions.connection):
+    """psycopg2 connection that tracks its pool usage and prepared statements"""
+    last_used = 0.0
+    busy: asyncio.Future[typing.Any] | None = None  # worker call running on the connection
+
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set[str] = set()
+
+
+def _execute(
+    con: _Connection,
+    commands: list[Command],
+    fetch: bool,
+    commit: bool,
+    timing: Timing
+) -> Rows:
+    """Executes commands in a single transaction on the given connection
+
+    Named statements are prepared on the connection the first time they are used on it.
+
+    Args:
+        con (_Connection): connection to execute on
+        commands (list[Command]): queries (or named statements) and their values
+        fetch (bool): whether to fetch the result of the last command
+        commit (bool): whether to commit once executed
+        timing (Timing): records the time taken by each command
+
+    Raises:
+        RuntimeError: Raised when fetch is set but the last command returns nothing
+
+    Returns:
+        Rows: Values returned by the last command (if fetched)
+    """
+    val: Rows = []
+    with con.cursor() as cur:
+        for (i, (query, values)) in enumerate(commands):
+            start = time.perf_counter()
+            if isinstance(query, Statement):
+                if query.name not in con.prepared:
+                    cur.execute(query.prepare)
+                    con.prepared.add(query.name)
+                cur.execute(query.execute, values)
+            else:
+                cur.execute(query, values)
+            last = i == len(commands) - 1
+            if last and commit:
+                con.commit()
+            executed = time.perf_counter()
+            fetched = None
+            if last and fetch:
+                if not cur.description:
+                    raise RuntimeError("Expected return values")
+                val = cur.fetchall()
+                fetched = time.perf_counter() - executed
+            timing.command(query, executed - start, fetched, len(val) if fetched is not None else 0)
     return val
 
 
-def single_sql(
+class Pool:
+    """Bounded pool of PostgreSQL connections, opened once at startup
+
+    Checkouts wait on a semaphore rather than exhausting the pool, and all blocking
+    driver calls run on the pool's own worker threads (one per connection, so a holder of
+    a connection can always make progress) and the event loop is never held up.
+    """
+
+    def __init__(self, dsn: str, size: int) -> None:
+        self.size = size
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            1, size, dsn, connection_factory=_Connection)
+        self._slots = asyncio.Semaphore(size)
+        self._threads = concurrent.futures.ThreadPoolExecutor(size, thread_name_prefix="db")
+        self._dsn = dsn
+        self._listeners: list[_Listener] = []
+
+    @staticmethod
+    def _healthy(con: _Connection) -> bool:
+        """Checks a connection is still usable, pinging it if it has been idle a while
+
+        Args:
+            con (_Connection): connection to check
+
+        Returns:
+            bool: True if the connection can be handed out
+        """
+        if con.closed:
+            return False
+        if con.last_used and time.monotonic() - con.last_used > IDLE_CHECK:
+            try:
+                with con.cursor() as cur:
+                    cur.execute("SELECT 1")
+                con.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _getconn(self) -> _Connection:
+        for _ in range(self.size + 1):
+            try:
+                con = typing.cast(_Connection, self._pool.getconn())
+            except psycopg2.OperationalError as err:
+                logger.critical(f"Failed to connect to database: {err}")
+                raise
+            if self._healthy(con):
+                return con
+            logger.warning("Discarding broken database connection")
+            self._pool.putconn(con, close=True)
+        raise psycopg2.OperationalError("No healthy database connection available")
+
+    def _putconn(self, con: _Connection) -> None:
+        con.last_used = time.monotonic()
+        self._pool.putconn(con, close=bool(con.closed))
+
+    def _submit(self, commands: list[Command], fetch: bool, timing: Timing, start: float) -> Rows:
+        con = self._getconn()
+        timing.connect = time.perf_counter() - start
+        try:
+            return _execute(con, commands, fetch, True, timing)
+        finally:
+            self._putconn(con)
+
+    async def call(self, con: _Connection, func: typing.Callable[..., T], *args: typing.Any) -> T:
+        """Runs a blocking function using a checked out connection on the pool's worker threads
+
+        The call is recorded on the connection, which is only returned to the pool once the
+        call is done, even if the caller is cancelled while waiting for it.
+
+        Args:
+            con (_Connection): checked out connection func uses
+            func (typing.Callable[..., T]): function to run
+            *args (typing.Any): arguments for func
+
+        Returns:
+            T: return value of func
+        """
+        future = asyncio.get_running_loop().run_in_executor(self._threads, func, *args)
+        con.busy = future
+        return await asyncio.shield(future)
+
+    def _release(self, con: _Connection) -> None:
+        """Returns a checked out connection to the pool and frees its slot, waiting first for
+        any call a cancelled caller left running on it
+
+        Args:
+            con (_Connection): connection to return
+        """
+        busy = con.busy
+        if busy is not None and not busy.done():
+            busy.add_done_callback(lambda _: self._release(con))
+            return
+        con.busy = None
+        returned = asyncio.get_running_loop().run_in_executor(self._threads, self._putconn, con)
+        returned.add_done_callback(lambda _: self._slots.release())
+
+    def _abandon(self, checkout: asyncio.Future[_Connection]) -> None:
+        """Returns the connection of a checkout whose caller stopped waiting for it
+
+        Args:
+            checkout (asyncio.Future[_Connection]): finished checkout
+        """
+        if checkout.cancelled() or checkout.exception() is not None:
+            self._slots.release()
+        else:
+            self._release(checkout.result())
+
+    @contextlib.asynccontextmanager
+    async def connection(self, timing: Timing | None = None) -> typing.AsyncIterator[_Connection]:
+        """Checks out a connection for the duration of the context
+
+        Any transaction left open when the connection is returned is rolled back.
+
+        Args:
+            timing (Timing | None, optional): records the time taken to check out.
+
+        Yields:
+            _Connection: the checked out connection
+        """
+        start = time.perf_counter()
+        await self._slots.acquire()
+        try:
+            checkout = asyncio.get_running_loop().run_in_executor(self._threads, self._getconn)
+        except BaseException:
+            self._slots.release()
+            raise
+        try:
+            con = await _guard(asyncio.shield(checkout))
+        except BaseException:
+            # the checkout may still succeed, its connection is then returned (and the slot
+            # freed) by _abandon rather than leaked
+            checkout.add_done_callback(self._abandon)
+            raise
+        if timing is not None:
+            timing.connect = time.perf_counter() - start
+        try:
+            yield con
+        finally:
+            self._release(con)
+
+    async def submit(self, commands: list[Command], fetch: bool, timing: Timing) -> Rows:
+        """Runs commands in a single transaction on a pooled connection
+
+        Args:
+            commands (list[Command]): queries (or named statements) and their values
+            fetch (bool): whether to fetch the result of the last command
+            timing (Timing): records the time taken to connect and by each command
+
+        Returns:
+            Rows: Values returned by the last command (if fetched)
+        """
+        start = time.perf_counter()
+        await self._slots.acquire()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                self._threads, self._submit, commands, fetch, timing, start)
+        except BaseException:
+            self._slots.release()
+            raise
+        # the slot is freed once the worker is done with the connection, not when the caller
+        # stops waiting, so a cancelled caller cannot let checkouts exceed the pool size
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.shield(future)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> typing.AsyncIterator[Transaction]:
+        """Holds a pooled connection and transaction, committing when the context exits
+
+        Yields:
+            Transaction: unit of work to submit statements through
+        """
+        timing = Timing()
+        async with self.connection(timing) as con:
+            yield Transaction(lambda command, fetch: self.call(
+                con, _execute, con, [command], fetch, False, timing), timing)
+            await _guard(self.call(con, con.commit))
+
+    async def listen(self, channel: str, callback: typing.Callable[[str | None], None]) -> None:
+        """Calls back with the payload of every notification sent on a channel
+
+        Args:
+            channel (str): channel to LISTEN on
+            callback (typing.Callable[[str | None], None]): called with each payload, or
+                with None after the connection was lost (and notifications may be missed)
+        """
+        listener = _Listener(self._dsn, channel, callback)
+        await listener.start()
+        self._listeners.append(listener)
+
+    def close(self) -> None:
+        """Closes every connection in the pool"""
+        for listener in self._listeners:
+            listener.close()
+        self._pool.closeall()
+        self._threads.shutdown(wait=False)
+
+
+class _Listener:
+    """Dedicated autocommit connection receiving the notifications of a channel
+
+    The connection is watched by the event loop, so no thread waits on it. If it is lost
+    it is reopened, and the callback told (with None) that notifications may have been missed.
+    """
+
+    def __init__(
+        self, dsn: str, channel: str, callback: typing.Callable[[str | None], None]
+    ) -> None:
+        self.channel = channel
+        self._dsn = dsn
+        self._callback = callback
+        self._con: psycopg2.extensions.connection | None = None
+        self._fd = -1
+        self._closed = False
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        con = psycopg2.connect(self._dsn)
+        con.autocommit = True
+        with con.cursor() as cur:
+            cur.execute(f"LISTEN {self.channel}")
+        return con
+
+    async def start(self) -> None:
+        """Opens the connection and starts listening"""
+        loop = asyncio.get_running_loop()
+        self._con = await loop.run_in_executor(None, self._connect)
+        self._fd = self._con.fileno()
+        loop.add_reader(self._fd, self._poll)
+
+    def _poll(self) -> None:
+        con = typing.cast(psycopg2.extensions.connection, self._con)
+        try:
+            con.poll()
+        except psycopg2.Error as err:
+            logger.error(f"Lost database notification connection: {err}")
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self._fd)
+            con.close()
+            loop.create_task(self._reconnect())
+            return
+        while con.notifies:
+            self._callback(con.notifies.pop(0).payload)
+
+    async def _reconnect(self) -> None:
+        while not self._closed:
+            await asyncio.sleep(LISTEN_RETRY)
+            try:
+                await self.start()
+            except psycopg2.Error as err:
+                logger.warning(f"Failed to reopen database notification connection: {err}")
+                continue
+            self._callback(None)
+            return
+
+    def close(self) -> None:
+        """Closes the connection (from outside the event loop)"""
+        self._closed = True
+        if self._con is not None:
+            self._con.close()
+
+
+class SqliteDatabase:
+    """Embedded SQLite database (WAL mode) for single-node deployments
+
+    SQLite has a single writer, so one connection is shared and units of work take turns
+    on it. The connection is opened on first use, queries are translated by sqlite_query.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._con: aiosqlite.Connection | None = None
+        self._lock = asyncio.Lock()
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._con is None:
+            logger.info(f"Opening SQLite database {self.path}")
+            self._con = await aiosqlite.connect(self.path, isolation_level=None)
+            for pragma in ["journal_mode=WAL", "synchronous=NORMAL", "foreign_keys=ON"]:
+                await self._con.execute(f"PRAGMA {pragma}")
+        return self._con
+
+    @staticmethod
+    async def _execute(
+        con: aiosqlite.Connection,
+        command: Command,
+        fetch: bool,
+        timing: Timing
+    ) -> Rows:
+        (query, values) = command
+        rows: Rows = []
+        description = None
+        (execute, fetched) = (0.0, 0.0)
+        for (statement, params) in sqlite_query(
+                query.sqlite if isinstance(query, Statement) else query, values):
+            start = time.perf_counter()
+            async with con.execute(statement, params) as cur:
+                executed = time.perf_counter()
+                description = cur.description
+                rows = [tuple(row) for row in await cur.fetchall()]
+                execute += executed - start
+                fetched += time.perf_counter() - executed
+        if fetch and not description:
+            raise RuntimeError("Expected return values")
+        timing.command(query, execute, fetched if fetch else None, len(rows) if fetch else 0)
+        return rows
+
+    @contextlib.asynccontextmanager
+    async def _session(self, timing: Timing) -> typing.AsyncIterator[aiosqlite.Connection]:
+        start = time.perf_counter()
+        async with self._lock:
+            con = await _guard(self._connection())
+            timing.connect = time.perf_counter() - start
+            await con.execute("BEGIN")
+            try:
+                yield con
+            except BaseException:
+                await con.execute("ROLLBACK")
+                raise
+            await _guard(con.execute("COMMIT"))
+
+    async def submit(self, commands: list[Command], fetch: bool, timing: Timing) -> Rows:
+        """Runs commands in a single transaction
+
+        Args:
+            commands (list[Command]): queries (or named statements) and their values
+            fetch (bool): whether to fetch the result of the last command
+            timing (Timing): records the time taken to connect and by each command
+
+        Returns:
+            Rows: Values returned by the last command (if fetched)
+        """
+        rows: Rows = []
+        async with self._session(timing) as con:
+            for (i, command) in enumerate(commands):
+                rows = await self._execute(
+                    con, command, fetch and i == len(commands) - 1, timing)
+        return rows if fetch else []
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> typing.AsyncIterator[Transaction]:
+        """Holds the connection in a transaction, committing when the context exits
+
+        Yields:
+            Transaction: unit of work to submit statements through
+        """
+        timing = Timing()
+        async with self._session(timing) as con:
+            yield Transaction(
+                lambda command, fetch: self._execute(con, command, fetch, timing), timing)
+
+    def close(self) -> None:
+        """Closes the connection (from outside the event loop)"""
+        if self._con is not None:
+            asyncio.run(self._con.close())
+            self._con = None
+
+
+_database: Pool | SqliteDatabase | None = None
+
+
+def open_db() -> None:
+    """
+    Opens the database backend selected by DATABASE_URL (a PostgreSQL connection pool,
+    or an embedded SQLite database for sqlite:/// URLs), must be called once before any
+    queries are made
+    """
+    global _database
+    if _database is not None:
+        return
+    url = database_url()
+    if is_sqlite(url):
+        _check_sqlite_version()
+        _database = SqliteDatabase(url[len(SQLITE_SCHEME):])
+    else:
+        logger.info(f"Opening database pool (size {POOL_SIZE})")
+        _database = Pool(url, POOL_SIZE)
+
+
+def shutdown_db() -> None:
+    """
+    Closes the database backend and stops the test server (if running)
+    """
+    global _database
+    if _database is not None:
+        _database.close()
+        _database = None
+    testdb.stop()
+
+
+def database_url() -> str:
+    """Gets the URL of the database to use
+
+    In debug mode this is a throwaway test server (unless DATABASE_URL selects SQLite),
+    which is only started the first time a connection is needed.
+
+    Returns:
+        str: database URL
+    """
+    if __debug__ and not is_sqlite(DATABASE_URL):
+        return testdb.url()
+    if DATABASE_URL is None:
+        raise RuntimeError("DATABASE_URL is not set")
+    return DATABASE_URL
+
+
+SyncConnection = sqlite3.Connection | psycopg2.extensions.connection
+
+
+def connect_sync(url: str | None = None) -> SyncConnection:
+    """Opens a plain (blocking) DB-API connection to the selected backend, for setup tasks
+
+    Run queries on it with run_sync, which translates them for SQLite.
+
+    Args:
+        url (str | None, optional): database URL. Defaults to database_url().
+
+    Raises:
+        RuntimeError: Raised when the SQLite backend is selected but SQLite is too old
+
+    Returns:
+        SyncConnection: new connection
+    """
+    url = url or database_url()
+    if is_sqlite(url):
+        _check_sqlite_version()
+        con = sqlite3.connect(url[len(SQLITE_SCHEME):], isolation_level=None)
+        con.execute("PRAGMA foreign_keys=ON")
+        return con
+    return psycopg2.connect(url)
+
+
+def run_sync(
+    con: SyncConnection,
     query: str,
-    values: tuple[typing.Any, ...] = (None,)
-) -> list[tuple[typing.Any, ...]]:
+    values: typing.Sequence[typing.Any] | None = None
+) -> list[typing.Any]:
+    """Runs a (Postgres dialect) query on a connection from connect_sync, returning any rows
+
+    Args:
+        con (SyncConnection): connection to run on
+        query (str): query to run
+        values (typing.Sequence[typing.Any] | None, optional): values for the query
+
+    Returns:
+        list[typing.Any]: rows returned by the query
     """
-    Opens a connection, submits a single SQL query to the database then cleans up
+    if isinstance(con, sqlite3.Connection):
+        rows = []
+        for (statement, params) in sqlite_query(query, values):
+            rows = con.execute(statement, params).fetchall()
+        return rows
+    with con.cursor() as cur:
+        cur.execute(query, values)
+        return cur.fetchall() if cur.description else []
+
+
+def _get_database() -> Pool | SqliteDatabase:
+    if _database is None:
+        raise RuntimeError("Database is not open")
+    return _database
+
+
+async def _guard(call: typing.Awaitable[T]) -> T:
+    """Awaits a database call, mapping driver errors to KeyViolation/RuntimeError
 
     Args:
-        query (string): SQL query to execute.
-        values (tuple, optional):
-            Values to provide to the SQL query (i.e. for %s). Defaults to None.
+        call (typing.Awaitable[T]): database call to await
 
     Raises:
         KeyViolation: Raised when key constraint is violated
+        RuntimeError: Raised on any other SQL error or warning
 
     Returns:
-        (list): Values returned from sql query as a list of tuples.
+        T: result of the call
     """
     try:
-        con = psycopg2.connect(DATABASE_URL)
-    except psycopg2.Error as err:
-        logger.critical(f"Failed to connect to database: {err}")
-    cur = con.cursor()
-    err_mess = None
-    try:
-        cur.execute(query, values if values != (None,) else None)
+        return await call
     except UniqueViolation as e:
         raise KeyViolation("Key constraint violated") from e
-    except psycopg2.Error as e:
+    except sqlite3.IntegrityError as e:
+        if "UNIQUE" in str(e):
+            raise KeyViolation("Key constraint violated") from e
+        err_mess = f"SQL Error: {e.__class__.__name__}\n{traceback.format_exc()}"
+        logger.error(err_mess)
+        raise RuntimeError(err_mess) from e
+    except (psycopg2.Error, sqlite3.Error) as e:
         err_mess = f"SQL Error: {e.__class__.__name__}\n{traceback.format_exc()}"
         logger.error(err_mess)
-    except psycopg2.Warning as e:
+        raise RuntimeError(err_mess) from e
+    except (psycopg2.Warning, sqlite3.Warning) as e:
         err_mess = f"SQL Warning: {e.__class__.__name__}\n{traceback.format_exc()}"
         logger.warning(err_mess)
+        raise RuntimeError(err_mess) from e
 
-    if cur.description:
-        val = cur.fetchall()
 
-    else:
-        err_mess = "Expected return values"
-    con.commit()
-    cur.close()
-    con.close()
-    if err_mess:
-        raise RuntimeError(err_mess)
-    return val
+async def _submit(commands: list[Command], fetch: bool) -> Rows:
+    """Submits commands to the database in a single transaction
+
+    Args:
+        commands (list[Command]): queries (or named statements) and their values
+        fetch (bool): whether to fetch the result of the last command
+
+    Returns:
+        Rows: Values returned by the last command (if fetched)
+    """
+    timing = Timing()
+    try:
+        return await _guard(_get_database().submit(commands, fetch, timing))
+    finally:
+        timing.record()
+
+
+async def notify(channel: str, payload: str) -> None:
+    """Sends a notification to every process listening on a channel (no-op with SQLite,
+    which only serves a single process)
+
+    Args:
+        channel (str): channel to notify
+        payload (str): payload of the notification
+    """
+    if isinstance(_get_database(), SqliteDatabase):
+        return
+    await _submit([("SELECT pg_notify(%s, %s)", (channel, payload))], False)
 
 
-def single_void_SQL(query: str, values: tuple[typing.Any, ...] = (None,)) -> None:
+async def listen(channel: str, callback: typing.Callable[[str | None], None]) -> None:
+    """Calls back with the payload of every notification sent on a channel (no-op with SQLite)
+
+    Args:
+        channel (str): channel to listen on
+        callback (typing.Callable[[str | None], None]): called with each payload, or with
+            None after the connection was lost (and notifications may have been missed)
+    """
+    database = _get_database()
+    if isinstance(database, Pool):
+        await _guard(database.listen(channel, callback))
+
+
+async def select_from_unsafe(table_name: str) -> typing.List[typing.Tuple[typing.Any, ...]]:
+    """logs select from table. ONLY FOR TESTING
+
+    Args:
+        table_name (str): table to select from
+
+    Returns:
+        typing.Optional[typing.Any]: returned values
+    """
+    return await _submit([(f'SELECT * FROM public.{table_name}', None)], True)
+
+
+async def single_sql(
+    query: str,
+    values: tuple[typing.Any, ...] = (None,)
+) -> list[tuple[typing.Any, ...]]:
     """
-    Opens a connection, submits a single SQL query to the database then cleans up
+    Submits a single SQL query to the database on a pooled connection
 
     Args:
         query (string): SQL query to execute.
@@ -91,34 +923,33 @@ def single_void_SQL(query: str, values: tuple[typing.Any, ...] = (None,)) -> Non
 
     Raises:
         KeyViolation: Raised when key constraint is violated
+
+    Returns:
+        (list): Values returned from sql query as a list of tuples.
     """
-    try:
-        con = psycopg2.connect(DATABASE_URL)
-    except psycopg2.Error as err:
-        logger.critical(f"Failed to connect to database: {err}")
-    cur = con.cursor()
-    err_mess = None
-    try:
-        cur.execute(query, values if values != (None,) else None)
-    except UniqueViolation as e:
-        raise KeyViolation("Key constraint violated") from e
-    except psycopg2.Error as e:
-        err_mess = f"SQL Error: {e.__class__.__name__}\n{traceback.format_exc()}"
-        logger.error(err_mess)
-    except psycopg2.Warning as e:
-        err_mess = f"SQL Warning: {e.__class__.__name__}\n{traceback.format_exc()}"
-        logger.warning(err_mess)
+    return await _submit([(query, values if values != (None,) else None)], True)
 
-    con.commit()
-    cur.close()
-    con.close()
-    if err_mess:
-        raise RuntimeError(err_mess)
 
+async def single_void_SQL(query: str, values: tuple[typing.Any, ...] = (None,)) -> None:
+    """
+    Submits a single SQL query to the database on a pooled connection
+
+    Args:
+        query (string): SQL query to execute.
+        values (tuple, optional):
+            Values to provide to the SQL query (i.e. for %s). Defaults to None.
+
+    Raises:
+        KeyViolation: Raised when key constraint is violated
+    """
+    await _submit([(query, values if values != (None,) else None)], False)
 
-def multi_void_sql(commands: list[tuple[str, tuple[typing.Any, ...]]]) -> None:
+
+async def multi_void_sql(commands: list[tuple[str, tuple[typing.Any, ...]]]) -> None:
     """Executes multiple commands for the database that don't have a return
 
+    All commands run on one pooled connection and are committed together.
+
     Args:
         commands (list[tuple[str, tuple[typing.Any, ...]]]):
             List of tuples where each tuple contains a string and a tuple.
@@ -126,87 +957,124 @@ def multi_void_sql(commands: list[tuple[str, tuple[typing.Any, ...]]]) -> None:
             the substituted values for the query.
 
     Raises:
-        KeyViolation: _description_
-        RuntimeError: _description_
+        KeyViolation: Raised when key constraint is violated
+        RuntimeError: Raised on any other SQL error or warning
     """
+    await _submit([(query, values) for (query, values) in commands], False)
+
+
+def _lookup(name: str) -> Statement:
     try:
-        con = psycopg2.connect(DATABASE_URL)
-    except psycopg2.Error as err:
-        logger.critical(f"Failed to connect to database: {err}")
-    cur = con.cursor()
-    err_mess = None
-    for (query, values) in commands:
+        statement = STATEMENTS[name]
+    except KeyError:
+        raise ValueError(f"No statement registered as {name}") from None
+    statement_calls[name] += 1
+    return statement
+
+
+async def named_sql(name: str, values: tuple[typing.Any, ...] = ()) -> list[tuple[typing.Any, ...]]:
+    """
+    Executes a registered statement by name, preparing it on first use of each connection
+
+    Args:
+        name (str): name the statement was registered under
+        values (tuple, optional): Values to provide to the statement. Defaults to ().
+
+    Raises:
+        KeyViolation: Raised when key constraint is violated
+
+    Returns:
+        (list): Values returned from the statement as a list of tuples.
+    """
+    return await _submit([(_lookup(name), values or None)], True)
+
+
+async def named_void_sql(name: str, values: tuple[typing.Any, ...] = ()) -> None:
+    """
+    Executes a registered statement by name, preparing it on first use of each connection
+
+    Args:
+        name (str): name the statement was registered under
+        values (tuple, optional): Values to provide to the statement. Defaults to ().
+
+    Raises:
+        KeyViolation: Raised when key constraint is violated
+    """
+    await _submit([(_lookup(name), values or None)], False)
+
+
+def transaction() -> typing.AsyncContextManager[Transaction]:
+    """
+    Holds one connection and transaction across several statements, committing once
+    when the context exits cleanly (and rolling back if it raises).
+    Only use the yielded Transaction inside the context, not the module level functions
+
+    Returns:
+        typing.AsyncContextManager[Transaction]: context yielding the unit of work
+    """
+    return _get_database().transaction()
+
+
+class BatchedStatement:
+    """Coalesces keys added in quick succession into a single call of a registered statement
+
+    Every placeholder of the statement is given the whole batch as an array (i.e. = ANY(%s)),
+    so a burst of events costs one round trip.
+
+    Args:
+        name (str): name of the registered statement
+        delay (float, optional): seconds to collect keys before flushing. Defaults to 1.
+    """
+
+    def __init__(self, name: str, delay: float = 1) -> None:
+        self.statement = STATEMENTS[name]
+        self.delay = delay
+        self._pending: set[int] = set()
+        self._flushing: asyncio.Task[None] | None = None
+
+    def add(self, key: int) -> None:
+        """Queues a key, scheduling a flush if one is not already pending
+
+        Args:
+            key (int): key to include in the next batch
+        """
+        self._pending.add(key)
+        if self._flushing is None:
+            self._flushing = asyncio.create_task(self._flush())
+
+    async def write(self, key: int) -> None:
+        """Queues a key and waits until its batch has been flushed
+
+        Args:
+            key (int): key to include in the next batch
+        """
+        self.add(key)
+        if self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self.delay)
+        keys = list(self._pending)
+        self._pending.clear()
+        self._flushing = None
+        logger.debug(f"Flushing {len(keys)} keys for {self.statement.name}")
         try:
-            cur.execute(query, values)
-        except UniqueViolation as e:
-            raise KeyViolation("Key constraint violated") from e
-        except psycopg2.Error as e:
-            err_mess = f"SQL Error: {e.__class__.__name__}\n{traceback.format_exc()}"
-            logger.error(err_mess)
-        except psycopg2.Warning as e:
-            err_mess = f"SQL Warning: {e.__class__.__name__}\n{traceback.format_exc()}"
-            logger.warning(err_mess)
-
-        if err_mess:
-            raise RuntimeError(err_mess)
-    con.commit()
-    cur.close()
-    con.close()
+            await named_void_sql(self.statement.name, (keys,) * self.statement.params)
+        except (KeyViolation, RuntimeError):
+            logger.error(f"Batched {self.statement.name} failed for keys {keys}")
 
 
-def populate() -> None:
+def populate(url: str | None = None) -> None:
     """
-    Sets up test database, and adds testing server as an entry
+    Adds testing servers as entries in the (freshly migrated) test database
+
+    Args:
+        url (str | None, optional): database URL. Defaults to database_url().
     """
     logger.info("Populating test database")
-    con = psycopg2.connect(DATABASE_URL)
-    cur = con.cursor()
-    cur.execute(
-        "CREATE TABLE Guilds(ID BIGINT, CountingChannelID BIGINT, BirthdayChannelID BIGINT, " +
-        "FactChannelID BIGINT, CurrentCount INTEGER, LastCounterID BIGINT, " +
-        "HighScoreCounting INTEGER, FailRoleID BIGINT, PRIMARY KEY(ID));"
-    )
-
-    cur.execute("CREATE TABLE Birthdays(GuildID BIGINT, UserID BIGINT, Birthdate TEXT, " +
-                "FOREIGN KEY(GuildID) REFERENCES Guilds(ID), PRIMARY KEY(GuildID, UserID));")
-
-    cur.execute("CREATE TABLE Subreddits(GuildID BIGINT, subreddit TEXT, " +
-                "SubredditChannelID BIGINT, PRIMARY KEY(GuildID, subreddit));")
-
-    cur.execute(
-        "CREATE TABLE ReactMessages(GuildID BIGINT, MessageID BIGINT, RoleID BIGINT, Emoji TEXT, " +
-        "FOREIGN KEY(GuildID) REFERENCES Guilds(ID), " +
-        "PRIMARY KEY(GuildID, MessageID, RoleID, Emoji));"
-    )
-
-    cur.execute(
-        "CREATE TABLE RoleChannel(GuildID BIGINT, RoleID BIGINT, ChannelID BIGINT, " +
-        "ToAdd BOOLEAN, FOREIGN KEY(GuildID) REFERENCES Guilds(ID), " +
-        "PRIMARY KEY(GuildID, ChannelID, RoleID));"
-    )
-
-    cur.execute(
-        "CREATE TABLE MessageChain(GuildID BIGINT, WatchedChannelID BIGINT, " +
-        "ResponseChannelID BIGINT, Message VARCHAR(2000), FOREIGN KEY(GuildID) " +
-        "REFERENCES Guilds(ID), PRIMARY KEY(GuildID, WatchedChannelID));"
-    )
-
-    cur.execute(
-        "CREATE TABLE ChainedUsers(GuildID BIGINT, UserID BIGINT, ChannelID BIGINT, " +
-        "FOREIGN KEY(GuildID, ChannelID) REFERENCES MessageChain(GuildID, WatchedChannelID), " +
-        "PRIMARY KEY(GuildID, UserID, ChannelID));")
-
-    cur.execute(
-        "INSERT INTO Guilds (ID, CountingChannelID, BirthdayChannelID, FactChannelID, " +
-        "CurrentCount, LastCounterID, HighScoreCounting, FailRoleID) VALUES (821016940462080000, " +
-        "NULL, NULL, NULL, 0, NULL, 0, NULL);")
-
-    cur.execute(
-        "INSERT INTO Guilds (ID, CountingChannelID, BirthdayChannelID, FactChannelID, " +
-        "CurrentCount, LastCounterID, HighScoreCounting, FailRoleID) VALUES " +
-        "(1026169937422729226, NULL, NULL, NULL, 0, NULL, 0, NULL);"
-    )
-
+    con = connect_sync(url)
+    for guild_id in [821016940462080000, 1026169937422729226]:
+        run_sync(con, "INSERT INTO Guilds (ID, BirthdayChannelID, FactChannelID) VALUES " +
+                 "(%s, NULL, NULL) ON CONFLICT DO NOTHING;", (guild_id,))
     con.commit()
-    cur.close()
     con.close()
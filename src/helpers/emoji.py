@@ -73,3 +73,17 @@ def string_to_partial_emoji(emoji: str) -> PartialEmoji:
         return PartialEmoji.from_str(emoji)
     else:
         raise ValueError(f"{emoji} is not a valid emoji")
+
+
+def emoji_key(emoji: PartialEmoji) -> int | str:
+    """Get a hashable key identifying an emoji, equal when the emojis compare equal
+
+    PartialEmoji hashes its name too, which can change for custom emojis
+
+    Args:
+        emoji (PartialEmoji): emoji to get the key of
+
+    Returns:
+        int | str: ID of a custom emoji, or the unicode emoji itself
+    """
+    return emoji.id if emoji.id is not None else emoji.name
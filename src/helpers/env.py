@@ -23,17 +23,13 @@ CLIENT_ID = load_env('CLIENT_ID')  # PRAW/Reddit API client ID
 SECRET_KEY = load_env('SECRET_KEY')  # PRAW/Reddit API secret key
 USER_AGENT = load_env('USER_AGENT')  # PRAW/Reddit API user agent
 NINJA_API_KEY = load_env('NINJA_API_KEY')  # X-API-Key for API-Ninjas
-DATABASE_URL = load_env('DATABASE_URL')  # PostgreSQL db
+DATABASE_URL = load_env('DATABASE_URL')  # PostgreSQL or sqlite:/// db (unused in debug mode)
 CAI_TOKEN = load_env('CAI_TOKEN')  # Character AI client token
 CAI_NIX_ID = load_env('CAI_NIX_ID')  # Character AI character ID of Nix bot
 DEBUG_GUILDS = os.getenv('DEBUG_GUILDS')  # Debug guilds (not required)
-
-if __debug__:
-    import testing.postgresql as tp  # type: ignore[import]
-    postgres = tp.Postgresql()
-    DATABASE_URL = postgres.url()
-
-
-def shutdown_db() -> None:
-    if __debug__:
-        postgres.stop()
+DATABASE_POOL_SIZE = os.getenv('DATABASE_POOL_SIZE')  # Max pooled db connections (not required)
+SLOW_QUERY_MS = os.getenv('SLOW_QUERY_MS')  # Slow query log threshold (not required)
+COUNTING_JOURNAL = os.getenv('COUNTING_JOURNAL')  # Persistent journal path (not required)
+COUNTING_SHARED = os.getenv('COUNTING_SHARED')  # Set if several processes count (not required)
+COUNTING_REACTIONS = os.getenv('COUNTING_REACTIONS')  # Busy channel policy (not required)
+DAILY_WINDOW_MINUTES = os.getenv('DAILY_WINDOW_MINUTES')  # Daily job spread (not required)
@@ -0,0 +1,115 @@
+import collections
+import sys
+import types
+
+
+class Histogram:
+    """Running count/total of a measurement, with percentiles over the most recent samples
+
+    Args:
+        size (int, optional): number of recent samples kept for percentiles. Defaults to 2048.
+    """
+
+    def __init__(self, size: int = 2048) -> None:
+        self.count = 0
+        self.total = 0.0
+        self._samples: collections.deque[float] = collections.deque(maxlen=size)
+
+    def add(self, value: float) -> None:
+        """Records a sample
+
+        Args:
+            value (float): sample to record
+        """
+        self.count += 1
+        self.total += value
+        self._samples.append(value)
+
+    def percentile(self, percent: float) -> float:
+        """Gets a percentile of the recent samples
+
+        Args:
+            percent (float): percentile to get (0-100)
+
+        Returns:
+            float: the percentile, or 0 if nothing has been recorded
+        """
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def summary(self, scale: float = 1000, unit: str = "ms") -> str:
+        """Formats count and p50/p95/p99 of the histogram
+
+        Args:
+            scale (float, optional): multiplier applied to samples. Defaults to 1000.
+            unit (str, optional): unit label for the scaled samples. Defaults to "ms".
+
+        Returns:
+            str: summary of the histogram
+        """
+        return f"n={self.count} " + " ".join(
+            [f"p{p}={self.percentile(p) * scale:.1f}{unit}" for p in [50, 95, 99]])
+
+
+def caller(skip: str) -> tuple[str, int]:
+    """Finds the class and guild ID of the first caller outside of the given module
+
+    Walks the (coroutine) call stack, so is only intended for rare paths such as slow logs.
+    The guild is taken from the first local with a guild_id, or a guild with an id.
+
+    Args:
+        skip (str): __name__ of the module to look past
+
+    Returns:
+        tuple[str, int]: class name of the caller ("No class" if none) and guild ID (or 0)
+    """
+    frame: types.FrameType | None = sys._getframe(1)
+    while frame is not None and frame.f_globals.get("__name__") == skip:
+        frame = frame.f_back
+    if frame is None:
+        return ("No class", 0)
+    call_class = (frame.f_locals["self"].__class__.__name__
+                  if "self" in frame.f_locals else "No class")
+    for value in frame.f_locals.values():
+        guild_id = getattr(value, "guild_id", None) or getattr(
+            getattr(value, "guild", None), "id", None)
+        if isinstance(guild_id, int):
+            return (call_class, guild_id)
+    return (call_class, 0)
+
+
+class CacheStats:
+    """Hit/miss counters of a cache, every instance is listed in CACHES
+
+    Args:
+        name (str): name of the cache (for reporting)
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        CACHES.append(self)
+
+    def hit(self) -> None:
+        """Records a lookup answered from the cache"""
+        self.hits += 1
+
+    def miss(self) -> None:
+        """Records a lookup that had to go to the source"""
+        self.misses += 1
+
+    def summary(self) -> str:
+        """Formats the counters of the cache
+
+        Returns:
+            str: summary of the cache
+        """
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return f"{self.name}: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)"
+
+
+CACHES: list[CacheStats] = []
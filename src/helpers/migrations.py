@@ -0,0 +1,274 @@
+import psycopg2
+import psycopg2.extensions
+import re
+import sqlite3
+import time
+from dataclasses import dataclass, field
+
+import helpers.database as db
+from helpers.logger import Logger
+
+logger = Logger()
+
+LOCK_ID = 7071  # advisory lock key, stops two processes migrating at once
+LOCK_POLL = 1  # seconds between attempts to take the migration lock
+CONCURRENT_INDEX = re.compile(r"CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+)", re.IGNORECASE)
+
+
+@dataclass
+class Migration:
+    """A numbered schema change, applied at most once per database
+
+    Migrations must never be edited once shipped, add a new one instead.
+    Non-transactional migrations (e.g. CREATE INDEX CONCURRENTLY) run in autocommit mode,
+    so each of their statements must be safe to re-run (IF NOT EXISTS etc.), an index left
+    invalid by a failed concurrent build is dropped before it is built again
+    Statements are translated for SQLite with db.sqlite_query, unless sqlite gives
+    replacements (for DDL SQLite cannot run, such as ALTER TABLE ... ADD CONSTRAINT)
+    Contract migrations remove what the previous release still uses, so during a rolling
+    deploy both releases work with the schema. They are only applied by migrate(contract=True)
+    once no instance of the previous release is left (and always on SQLite, which only
+    serves one process)
+    """
+    version: int
+    description: str
+    statements: list[str] = field(default_factory=list)
+    transactional: bool = True
+    sqlite: list[str] | None = None
+    contract: bool = False
+
+
+COUNTING_COLUMNS = ["CountingChannelID", "CurrentCount", "LastCounterID", "HighScoreCounting",
+                    "FailRoleID"]
+
+MIGRATIONS = [
+    Migration(1, "baseline schema", [
+        "CREATE TABLE IF NOT EXISTS Guilds(ID BIGINT, CountingChannelID BIGINT, " +
+        "BirthdayChannelID BIGINT, FactChannelID BIGINT, CurrentCount INTEGER, " +
+        "LastCounterID BIGINT, HighScoreCounting INTEGER, FailRoleID BIGINT, PRIMARY KEY(ID));",
+
+        "CREATE TABLE IF NOT EXISTS Birthdays(GuildID BIGINT, UserID BIGINT, Birthdate TEXT, " +
+        "FOREIGN KEY(GuildID) REFERENCES Guilds(ID), PRIMARY KEY(GuildID, UserID));",
+
+        "CREATE TABLE IF NOT EXISTS Subreddits(GuildID BIGINT, subreddit TEXT, " +
+        "SubredditChannelID BIGINT, PRIMARY KEY(GuildID, subreddit));",
+
+        "CREATE TABLE IF NOT EXISTS ReactMessages(GuildID BIGINT, MessageID BIGINT, " +
+        "RoleID BIGINT, Emoji TEXT, FOREIGN KEY(GuildID) REFERENCES Guilds(ID), " +
+        "PRIMARY KEY(GuildID, MessageID, RoleID, Emoji));",
+
+        "CREATE TABLE IF NOT EXISTS RoleChannel(GuildID BIGINT, RoleID BIGINT, " +
+        "ChannelID BIGINT, ToAdd BOOLEAN, FOREIGN KEY(GuildID) REFERENCES Guilds(ID), " +
+        "PRIMARY KEY(GuildID, ChannelID, RoleID));",
+
+        "CREATE TABLE IF NOT EXISTS MessageChain(GuildID BIGINT, WatchedChannelID BIGINT, " +
+        "ResponseChannelID BIGINT, Message VARCHAR(2000), FOREIGN KEY(GuildID) " +
+        "REFERENCES Guilds(ID), PRIMARY KEY(GuildID, WatchedChannelID));",
+
+        "CREATE TABLE IF NOT EXISTS ChainedUsers(GuildID BIGINT, UserID BIGINT, " +
+        "ChannelID BIGINT, FOREIGN KEY(GuildID, ChannelID) REFERENCES " +
+        "MessageChain(GuildID, WatchedChannelID), PRIMARY KEY(GuildID, UserID, ChannelID));",
+    ], sqlite=[  # SQLite databases are always new, so get the cascades of migration 3 here
+        "CREATE TABLE IF NOT EXISTS Guilds(ID BIGINT, CountingChannelID BIGINT, " +
+        "BirthdayChannelID BIGINT, FactChannelID BIGINT, CurrentCount INTEGER, " +
+        "LastCounterID BIGINT, HighScoreCounting INTEGER, FailRoleID BIGINT, PRIMARY KEY(ID));",
+
+        "CREATE TABLE IF NOT EXISTS Birthdays(GuildID BIGINT, UserID BIGINT, Birthdate TEXT, " +
+        "FOREIGN KEY(GuildID) REFERENCES Guilds(ID) ON DELETE CASCADE, " +
+        "PRIMARY KEY(GuildID, UserID));",
+
+        "CREATE TABLE IF NOT EXISTS Subreddits(GuildID BIGINT, subreddit TEXT, " +
+        "SubredditChannelID BIGINT, FOREIGN KEY(GuildID) REFERENCES Guilds(ID) " +
+        "ON DELETE CASCADE, PRIMARY KEY(GuildID, subreddit));",
+
+        "CREATE TABLE IF NOT EXISTS ReactMessages(GuildID BIGINT, MessageID BIGINT, " +
+        "RoleID BIGINT, Emoji TEXT, FOREIGN KEY(GuildID) REFERENCES Guilds(ID) " +
+        "ON DELETE CASCADE, PRIMARY KEY(GuildID, MessageID, RoleID, Emoji));",
+
+        "CREATE TABLE IF NOT EXISTS RoleChannel(GuildID BIGINT, RoleID BIGINT, " +
+        "ChannelID BIGINT, ToAdd BOOLEAN, FOREIGN KEY(GuildID) REFERENCES Guilds(ID) " +
+        "ON DELETE CASCADE, PRIMARY KEY(GuildID, ChannelID, RoleID));",
+
+        "CREATE TABLE IF NOT EXISTS MessageChain(GuildID BIGINT, WatchedChannelID BIGINT, " +
+        "ResponseChannelID BIGINT, Message VARCHAR(2000), FOREIGN KEY(GuildID) " +
+        "REFERENCES Guilds(ID) ON DELETE CASCADE, PRIMARY KEY(GuildID, WatchedChannelID));",
+
+        "CREATE TABLE IF NOT EXISTS ChainedUsers(GuildID BIGINT, UserID BIGINT, " +
+        "ChannelID BIGINT, FOREIGN KEY(GuildID, ChannelID) REFERENCES " +
+        "MessageChain(GuildID, WatchedChannelID) ON DELETE CASCADE, " +
+        "PRIMARY KEY(GuildID, UserID, ChannelID));",
+    ]),
+    Migration(2, "secondary indexes on lookup columns", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ReactMessagesMessageID " +
+        "ON ReactMessages(MessageID);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS RoleChannelChannelID ON RoleChannel(ChannelID);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS SubredditsChannelID " +
+        "ON Subreddits(SubredditChannelID);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS MessageChainWatchedChannelID " +
+        "ON MessageChain(WatchedChannelID);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS MessageChainResponseChannelID " +
+        "ON MessageChain(ResponseChannelID);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ChainedUsersChannelID " +
+        "ON ChainedUsers(ChannelID);",
+    ], transactional=False),
+    Migration(3, "cascade deletes from guilds and chains", [
+        "DELETE FROM Subreddits WHERE GuildID NOT IN (SELECT ID FROM Guilds);",
+        "ALTER TABLE Subreddits ADD CONSTRAINT subreddits_guildid_fkey " +
+        "FOREIGN KEY(GuildID) REFERENCES Guilds(ID) ON DELETE CASCADE;",
+    ] + [
+        f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table.lower()}_guildid_fkey, " +
+        f"ADD CONSTRAINT {table.lower()}_guildid_fkey " +
+        "FOREIGN KEY(GuildID) REFERENCES Guilds(ID) ON DELETE CASCADE;"
+        for table in ["Birthdays", "ReactMessages", "RoleChannel", "MessageChain"]
+    ] + [
+        "ALTER TABLE ChainedUsers DROP CONSTRAINT IF EXISTS chainedusers_guildid_channelid_fkey, " +
+        "ADD CONSTRAINT chainedusers_guildid_channelid_fkey FOREIGN KEY(GuildID, ChannelID) " +
+        "REFERENCES MessageChain(GuildID, WatchedChannelID) ON DELETE CASCADE;",
+    ], sqlite=[]),
+    Migration(4, "per-channel counting state", [
+        # Only the primary key is indexed and pages keep free space, so counts are HOT updates
+        "CREATE TABLE IF NOT EXISTS Counting(ChannelID BIGINT, GuildID BIGINT NOT NULL, " +
+        "CurrentCount INTEGER NOT NULL DEFAULT 0, LastCounterID BIGINT, " +
+        "HighScore INTEGER NOT NULL DEFAULT 0, FailRoleID BIGINT, FOREIGN KEY(GuildID) " +
+        "REFERENCES Guilds(ID) ON DELETE CASCADE, PRIMARY KEY(ChannelID)) WITH (fillfactor=50);",
+        "CREATE INDEX IF NOT EXISTS CountingGuildID ON Counting(GuildID);",
+        "INSERT INTO Counting (ChannelID, GuildID, CurrentCount, LastCounterID, HighScore, " +
+        "FailRoleID) SELECT CountingChannelID, ID, COALESCE(CurrentCount, 0), LastCounterID, " +
+        "COALESCE(HighScoreCounting, 0), FailRoleID FROM Guilds " +
+        "WHERE CountingChannelID IS NOT NULL;",
+    ]),
+    Migration(5, "numeric indexed birthdates", [
+        "ALTER TABLE Birthdays ADD COLUMN BirthMonth SMALLINT;",
+        "ALTER TABLE Birthdays ADD COLUMN BirthDay SMALLINT;",
+        "UPDATE Birthdays SET BirthMonth=CASE substr(Birthdate, 1, 3) " +
+        " ".join([f"WHEN '{month}' THEN {i + 1}" for (i, month) in enumerate([
+            "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+            "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])]) +
+        " END, BirthDay=CAST(substr(Birthdate, 4) AS SMALLINT);",
+        "CREATE INDEX IF NOT EXISTS BirthdaysDate ON Birthdays(BirthMonth, BirthDay);",
+    ]),
+    Migration(6, "guild time zones", [
+        "ALTER TABLE Guilds ADD COLUMN TimeZone TEXT;",
+    ]),
+    Migration(7, "durable daily jobs", [
+        "CREATE TABLE IF NOT EXISTS DailyJobs(GuildID BIGINT, Feature TEXT, Day TEXT, " +
+        "RunAt BIGINT NOT NULL, Attempts INTEGER NOT NULL DEFAULT 0, " +
+        "Done BOOLEAN NOT NULL DEFAULT FALSE, FOREIGN KEY(GuildID) REFERENCES Guilds(ID) " +
+        "ON DELETE CASCADE, PRIMARY KEY(GuildID, Feature, Day));",
+        "CREATE INDEX IF NOT EXISTS DailyJobsDue ON DailyJobs(RunAt) WHERE NOT Done;",
+    ]),
+    Migration(8, "drop guild counting columns moved by migration 4", [
+        f"ALTER TABLE Guilds DROP COLUMN IF EXISTS {column};" for column in COUNTING_COLUMNS
+    ], sqlite=[
+        f"ALTER TABLE Guilds DROP COLUMN {column};" for column in COUNTING_COLUMNS
+    ], contract=True),
+    Migration(9, "drop birthdates replaced by migration 5", [
+        "ALTER TABLE Birthdays DROP COLUMN IF EXISTS Birthdate;",
+    ], sqlite=[
+        "ALTER TABLE Birthdays DROP COLUMN Birthdate;",
+    ], contract=True),
+]
+
+
+def _drop_invalid_index(con: psycopg2.extensions.connection, statement: str) -> None:
+    """Drops the index a CREATE INDEX CONCURRENTLY statement builds if an earlier, failed
+    build left it invalid, as IF NOT EXISTS would otherwise skip it
+
+    Args:
+        con (psycopg2.extensions.connection): autocommit connection to run on
+        statement (str): statement about to be run
+    """
+    match = CONCURRENT_INDEX.match(statement)
+    if match is None:
+        return
+    invalid = db.run_sync(
+        con, "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (match[1],))
+    if invalid and invalid[0][0]:
+        logger.warning(f"Dropping invalid index {match[1]} left by a failed build")
+        db.run_sync(con, f"DROP INDEX CONCURRENTLY IF EXISTS {match[1]};")
+
+
+def _apply(con: db.SyncConnection, migration: Migration) -> None:
+    """Applies a single migration and records its version
+
+    Args:
+        con (db.SyncConnection): connection to migrate with
+        migration (Migration): migration to apply
+    """
+    statements = migration.statements
+    if isinstance(con, sqlite3.Connection):
+        if migration.sqlite is not None:
+            statements = migration.sqlite
+    else:
+        con.autocommit = not migration.transactional
+    for statement in statements:
+        if isinstance(con, psycopg2.extensions.connection) and not migration.transactional:
+            _drop_invalid_index(con, statement)
+        db.run_sync(con, statement)
+    db.run_sync(con, "INSERT INTO SchemaVersion (Version, Description) VALUES (%s, %s)",
+                (migration.version, migration.description))
+    if isinstance(con, psycopg2.extensions.connection):
+        if migration.transactional:
+            con.commit()
+        con.autocommit = False
+
+
+def latest_version() -> int:
+    """Gets the version the schema has once all migrations are applied
+
+    Returns:
+        int: highest migration version
+    """
+    return max(migration.version for migration in MIGRATIONS)
+
+
+def migrate(url: str | None = None, contract: bool = False) -> None:
+    """
+    Brings the database schema up to date, applying any migrations not yet recorded
+    in the SchemaVersion table (in version order)
+
+    Args:
+        url (str | None, optional): database URL. Defaults to db.database_url().
+        contract (bool, optional): whether to also apply contract migrations.
+            Defaults to False.
+    """
+    con = db.connect_sync(url)
+    try:
+        if isinstance(con, sqlite3.Connection):
+            con.execute("BEGIN IMMEDIATE")  # holds the write lock until all are applied
+        else:
+            con.autocommit = True
+            # polled rather than waited for, a session blocked on the lock would hold a
+            # snapshot that the other process' concurrent index builds wait for
+            if not db.run_sync(con, "SELECT pg_try_advisory_lock(%s)", (LOCK_ID,))[0][0]:
+                logger.info("Waiting for another process to finish migrating")
+                while not db.run_sync(con, "SELECT pg_try_advisory_lock(%s)", (LOCK_ID,))[0][0]:
+                    time.sleep(LOCK_POLL)
+        db.run_sync(con, "CREATE TABLE IF NOT EXISTS SchemaVersion(Version INTEGER, " +
+                    "Description TEXT, Applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP, " +
+                    "PRIMARY KEY(Version));")
+        applied = {version for (version,) in db.run_sync(con, "SELECT Version FROM SchemaVersion")}
+        if isinstance(con, psycopg2.extensions.connection):
+            con.autocommit = False
+        contract = contract or isinstance(con, sqlite3.Connection)
+
+        pending = sorted([m for m in MIGRATIONS if m.version not in applied],
+                         key=lambda m: m.version)
+        waiting = [m.version for m in pending if m.contract and not contract]
+        pending = [m for m in pending if contract or not m.contract]
+        if waiting:
+            logger.info(f"Contract migrations {waiting} wait for migrate(contract=True)")
+        if not pending:
+            logger.info(f"Database schema is up to date (version {max(applied, default=0)})")
+        for migration in pending:
+            logger.info(f"Applying migration {migration.version}: {migration.description}")
+            try:
+                _apply(con, migration)
+            except (psycopg2.Error, sqlite3.Error) as err:
+                con.rollback()
+                logger.critical(f"Migration {migration.version} failed: {err}")
+                raise
+        if isinstance(con, sqlite3.Connection):
+            con.execute("COMMIT")
+    finally:
+        con.close()  # also releases the advisory lock
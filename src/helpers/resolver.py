@@ -0,0 +1,150 @@
+import asyncio
+import collections
+import time
+import typing
+
+import discord
+
+from helpers.metrics import CacheStats
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+CACHE_SIZE = 4096  # entries kept of each kind
+GUILD_TTL = 3600  # seconds a fetched guild is trusted
+MEMBER_TTL = 60  # seconds a fetched member is trusted, its roles change more often
+CONCURRENCY = 5  # REST lookups in flight at once
+
+
+def mention(user_id: int) -> str:
+    """Builds the mention of a user from its ID, no lookup needed
+
+    Args:
+        user_id (int): ID of the user
+
+    Returns:
+        str: mention of the user
+    """
+    return f"<@{user_id}>"
+
+
+class _Recent(typing.Generic[K, V]):
+    """Least recently used cache whose entries expire
+
+    Args:
+        ttl (float): seconds an entry is kept
+        size (int): number of entries kept
+    """
+
+    def __init__(self, ttl: float, size: int) -> None:
+        self.ttl = ttl
+        self.size = size
+        self._entries: collections.OrderedDict[K, tuple[V, float]] = collections.OrderedDict()
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[1] > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: K, value: V) -> None:
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+class Resolver:
+    """Gets members and guilds by ID with as few REST calls as possible
+
+    Looks in the gateway cache first, then in a cache of earlier fetches, and only then
+    fetches, with at most CONCURRENCY fetches in flight. Concurrent lookups of the same ID
+    share one fetch. Where only a mention is needed use mention() instead, it needs no lookup.
+    """
+
+    def __init__(self) -> None:
+        self.bot: discord.Bot | None = None
+        self.stats = CacheStats("members")
+        self._members: _Recent[tuple[int, int], discord.Member] = _Recent(MEMBER_TTL, CACHE_SIZE)
+        self._guilds: _Recent[int, discord.Guild] = _Recent(GUILD_TTL, CACHE_SIZE)
+        self._pending: dict[tuple[typing.Any, ...], asyncio.Future[typing.Any]] = {}
+        self._slots = asyncio.Semaphore(CONCURRENCY)
+
+    def set_bot(self, discord_bot: discord.Bot) -> None:
+        """Set discord bot, required for any lookup
+
+        Args:
+            discord_bot (discord.Bot): bot to set
+        """
+        self.bot = discord_bot
+
+    def _bot(self) -> discord.Bot:
+        if self.bot is None:
+            raise RuntimeError("Resolver used before the bot was set")
+        return self.bot
+
+    async def _fetch(
+        self,
+        key: tuple[typing.Any, ...],
+        cache: _Recent[typing.Any, V],
+        cache_key: typing.Any,
+        fetch: typing.Callable[[], typing.Awaitable[V]]
+    ) -> V:
+        pending = self._pending.get(key)
+        if pending is None:
+            async def limited() -> V:
+                async with self._slots:
+                    value = await fetch()
+                cache.put(cache_key, value)
+                return value
+            pending = asyncio.ensure_future(limited())
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return typing.cast(V, await asyncio.shield(pending))
+
+    async def guild(self, guild_id: int) -> discord.Guild:
+        """Gets a guild
+
+        Args:
+            guild_id (int): ID of the guild
+
+        Raises:
+            discord.HTTPException: Raised when fetching the guild failed
+
+        Returns:
+            discord.Guild: the guild
+        """
+        guild = self._bot().get_guild(guild_id) or self._guilds.get(guild_id)
+        if guild is not None:
+            return guild
+        return await self._fetch(("guild", guild_id), self._guilds, guild_id,
+                                 lambda: self._bot().fetch_guild(guild_id))
+
+    async def member(self, guild_id: int, user_id: int) -> discord.Member:
+        """Gets a member of a guild
+
+        Args:
+            guild_id (int): ID of the guild
+            user_id (int): ID of the user
+
+        Raises:
+            discord.HTTPException: Raised when fetching the guild or member failed
+
+        Returns:
+            discord.Member: the member
+        """
+        guild = await self.guild(guild_id)
+        member = guild.get_member(user_id) or self._members.get((guild_id, user_id))
+        if member is not None:
+            self.stats.hit()
+            return member
+        self.stats.miss()
+        return await self._fetch(("member", guild_id, user_id), self._members,
+                                 (guild_id, user_id), lambda: guild.fetch_member(user_id))
+
+
+resolver = Resolver()
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+import discord
+
+from helpers.logger import Logger
+
+logger = Logger()
+
+RECENT_TTL = 10  # seconds roles changed by the bot are trusted over the (not yet updated) cache
+
+
+@dataclass
+class _Batch:
+    """Role changes pending for a member and the callers waiting on them"""
+    member: discord.Member
+    roles: dict[int, bool] = field(default_factory=dict)  # role ID: add (or else remove)
+    reason: str | None = None
+    waiters: list[asyncio.Future[None]] = field(default_factory=list)
+
+
+class RoleChanges:
+    """Applies wanted roles to members with as few REST calls as possible
+
+    Changes are compared to the member's roles and dropped if they change nothing. Changes
+    requested for a member while an edit of it is in flight are merged into one batch. Only
+    the roles that change are sent (never the member's whole role list, which may be stale),
+    so roles changed meanwhile by moderators or other bots are kept.
+    """
+
+    def __init__(self) -> None:
+        self.requested = 0
+        self.calls = 0
+        self._pending: dict[tuple[int, int], _Batch] = {}
+        self._workers: dict[tuple[int, int], asyncio.Task[None]] = {}
+        self._recent: dict[tuple[int, int], tuple[dict[int, bool], float]] = {}
+
+    async def change(
+        self,
+        member: discord.Member,
+        roles: dict[int, bool],
+        reason: str | None = None
+    ) -> None:
+        """Adds and removes roles of a member, returning once applied
+
+        Args:
+            member (discord.Member): member to change
+            roles (dict[int, bool]): whether to add (or else remove) each role ID
+            reason (str | None, optional): reason shown in the audit log. Defaults to None.
+
+        Raises:
+            discord.HTTPException: Raised when the change failed (e.g. Forbidden)
+        """
+        if not roles:
+            return
+        self.requested += len(roles)
+        key = (member.guild.id, member.id)
+        batch = self._pending.setdefault(key, _Batch(member))
+        batch.member = member
+        batch.roles |= roles
+        batch.reason = reason or batch.reason
+        waiter = asyncio.get_running_loop().create_future()
+        batch.waiters.append(waiter)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._apply(key))
+        await waiter
+
+    def _current(self, key: tuple[int, int], member: discord.Member) -> set[int]:
+        roles = {role.id for role in member.roles if not role.is_default()}
+        (recent, since) = self._recent.get(key, ({}, 0.0))
+        if time.monotonic() - since < RECENT_TTL:  # the cache may not have our changes yet
+            roles = {role_id for role_id in roles if recent.get(role_id, True)}
+            roles |= {role_id for (role_id, add) in recent.items() if add}
+        return roles
+
+    def _remember(self, key: tuple[int, int], changed: dict[int, bool]) -> None:
+        now = time.monotonic()
+        (recent, since) = self._recent.get(key, ({}, 0.0))
+        self._recent[key] = ((recent if now - since < RECENT_TTL else {}) | changed, now)
+        if len(self._recent) > 1024:
+            self._recent = {recent_key: value for (recent_key, value) in self._recent.items()
+                            if now - value[1] < RECENT_TTL}
+
+    async def _edit(self, key: tuple[int, int], batch: _Batch) -> None:
+        current = self._current(key, batch.member)
+        changed = {role_id: add for (role_id, add) in batch.roles.items()
+                   if add != (role_id in current)}
+        if not changed:
+            return
+        adds = [discord.Object(role_id) for (role_id, add) in changed.items() if add]
+        removes = [discord.Object(role_id) for (role_id, add) in changed.items() if not add]
+        self.calls += len(changed)  # one request per role
+        if adds:
+            await batch.member.add_roles(*adds, reason=batch.reason)
+        if removes:
+            await batch.member.remove_roles(*removes, reason=batch.reason)
+        self._remember(key, changed)
+
+    async def _apply(self, key: tuple[int, int]) -> None:
+        try:
+            while key in self._pending:
+                batch = self._pending.pop(key)
+                try:
+                    await self._edit(key, batch)
+                except Exception as err:  # handed to the callers to handle
+                    for waiter in batch.waiters:
+                        if not waiter.done():
+                            waiter.set_exception(err)
+                else:
+                    for waiter in batch.waiters:
+                        if not waiter.done():
+                            waiter.set_result(None)
+        finally:
+            del self._workers[key]
+
+    def summary(self) -> str:
+        """Formats the counts of role changes requested and REST calls made
+
+        Returns:
+            str: summary of the role changes
+        """
+        return (f"role changes: {self.requested} requested, {self.calls} calls, " +
+                f"{self.requested - self.calls} saved")
+
+
+role_changes = RoleChanges()
@@ -0,0 +1,81 @@
+import asyncio
+import time
+import traceback
+import typing
+from dataclasses import dataclass, field
+
+import discord
+
+from helpers.logger import Logger
+from helpers.metrics import Histogram
+
+logger = Logger()
+
+Handler = typing.Callable[[discord.Message], typing.Awaitable[None]]
+Match = typing.Callable[[discord.Message], typing.Awaitable[bool]]
+
+
+@dataclass
+class Route:
+    """A feature's message handler, the check selecting its messages and its latencies"""
+    name: str
+    handler: Handler
+    match: Match
+    guild_only: bool = True
+    timing: Histogram = field(default_factory=Histogram)
+
+
+class MessageRouter:
+    """Single on_message dispatcher for every feature that reacts to messages
+
+    The common checks (bot online, not its own message, guild channel) are made once, then
+    each route's match decides if its handler applies. Matches only look at in-memory state
+    (the settings caches, active games) so messages no feature cares about cost no database
+    or REST calls. The handlers that apply run concurrently and are timed.
+    """
+
+    def __init__(self) -> None:
+        self.routes: dict[str, Route] = {}
+
+    def add(self, name: str, handler: Handler, match: Match, guild_only: bool = True) -> None:
+        """Registers (or replaces) a route
+
+        Args:
+            name (str): name of the route (for reporting)
+            handler (Handler): called with each message the route applies to
+            match (Match): checks whether the route applies to a message
+            guild_only (bool, optional): whether to skip private channels. Defaults to True.
+        """
+        self.routes[name] = Route(name, handler, match, guild_only)
+
+    async def dispatch(self, msg: discord.Message, bot_user: discord.ClientUser | None) -> None:
+        """Runs the handlers of every route that applies to a message
+
+        Args:
+            msg (discord.Message): message that was sent
+            bot_user (discord.ClientUser | None): user of the bot
+        """
+        if bot_user is None:
+            logger.error("Bot is offline", channel_id=msg.channel.id)
+            return
+        if msg.author.id == bot_user.id:
+            return
+        private = msg.guild is None or isinstance(msg.channel, discord.abc.PrivateChannel)
+        routes = [route for route in self.routes.values()
+                  if not (private and route.guild_only) and await route.match(msg)]
+        if routes:
+            await asyncio.gather(*[self._run(route, msg) for route in routes])
+
+    @staticmethod
+    async def _run(route: Route, msg: discord.Message) -> None:
+        start = time.perf_counter()
+        try:
+            await route.handler(msg)
+        except Exception:  # one failing feature must not stop the others
+            logger.error(f"Error in {route.name} message handler\n{traceback.format_exc()}",
+                         member_id=msg.author.id, channel_id=msg.channel.id)
+        finally:
+            route.timing.add(time.perf_counter() - start)
+
+
+router = MessageRouter()
@@ -0,0 +1,214 @@
+import asyncio
+import datetime as dt
+import hashlib
+import traceback
+import typing
+import zoneinfo
+
+import helpers.database as db
+import helpers.settings as settings
+from helpers.env import DAILY_WINDOW_MINUTES
+from helpers.logger import Logger
+from helpers.style import TIME
+
+logger = Logger()
+
+WINDOW = dt.timedelta(minutes=int(DAILY_WINDOW_MINUTES or 120))  # spread of the daily jobs
+TICK = 60  # seconds between checks for guilds whose jobs are due
+CATCH_UP = dt.timedelta(hours=1)  # jobs due this long before startup are still queued
+LEASE = 15 * 60  # seconds a claimed job is held before another process may take it over
+BACKOFF = 5 * 60  # seconds before the first retry of a failed job, doubling each attempt
+MAX_ATTEMPTS = 5
+BATCH = 500  # jobs claimed at once
+KEEP = dt.timedelta(days=7)  # how long jobs are kept
+
+# called with the due guild IDs and their local day, returns the guild IDs to retry
+Job = typing.Callable[[list[int], dt.date], typing.Awaitable[set[int]]]
+Configured = typing.Callable[[settings.GuildSettings], bool]  # whether a guild uses a job
+
+
+def offset(guild_id: int) -> dt.timedelta:
+    """Gets the stable offset of a guild's daily jobs into the window
+
+    Args:
+        guild_id (int): ID of the guild
+
+    Returns:
+        dt.timedelta: time after TIME the guild's jobs run
+    """
+    digest = hashlib.blake2b(guild_id.to_bytes(8, "big"), digest_size=4).digest()
+    return dt.timedelta(seconds=int.from_bytes(digest, "big") % max(1, int(WINDOW.total_seconds())))
+
+
+def zone(name: str | None) -> dt.tzinfo:
+    """Gets a time zone by name, UTC if it is not set or unknown
+
+    Args:
+        name (str | None): IANA name of the time zone
+
+    Returns:
+        dt.tzinfo: the time zone
+    """
+    if name:
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            logger.error(f"Unknown time zone {name}, using UTC")
+    return dt.timezone.utc
+
+
+def due_day(guild_id: int, time_zone: str | None,
+            since: dt.datetime, now: dt.datetime) -> dt.date | None:
+    """Gets the local day whose daily jobs became due for a guild between two instants
+
+    Args:
+        guild_id (int): ID of the guild
+        time_zone (str | None): IANA name of the guild's time zone (None for UTC)
+        since (dt.datetime): previous check (exclusive)
+        now (dt.datetime): this check (inclusive)
+
+    Returns:
+        dt.date | None: the guild's local day that is due, None if nothing is due
+    """
+    tz = zone(time_zone)
+    today = now.astimezone(tz).date()
+    for day in (today - dt.timedelta(days=1), today):
+        at = dt.datetime.combine(day, TIME, tzinfo=tz) + offset(guild_id)
+        if since < at <= now:
+            return day
+    return None
+
+
+class DailyScheduler:
+    """Runs the daily jobs of each guild once a day, spread over a window from TIME
+
+    Each guild gets a stable offset into the window (so its posts arrive at the same time
+    every day) in its own time zone, instead of every guild's jobs firing in the same minute.
+
+    Due jobs are queued in the DailyJobs table keyed by guild, feature and day, so each is
+    queued once however often the bot restarts and however many processes run it. Every
+    process claims batches of queued jobs, skipping those claimed by another, and retries
+    the guilds a job failed for with exponential back-off, up to MAX_ATTEMPTS times.
+    """
+
+    def __init__(self) -> None:
+        self.jobs: dict[str, Job] = {}
+        self.configured: dict[str, Configured] = {}
+        self._task: asyncio.Task[None] | None = None
+        self._last = dt.datetime.now(dt.timezone.utc) - CATCH_UP
+        self._pruned = 0.0
+
+    def add(self, name: str, job: Job, configured: Configured) -> None:
+        """Registers (or replaces) a daily job
+
+        Args:
+            name (str): name of the job (its feature in the DailyJobs table)
+            job (Job): called with the IDs of the due guilds and their local day, returns the
+                IDs of the guilds to retry
+            configured (Configured): whether a guild's settings use the job, only these
+                guilds are queued
+        """
+        self.jobs[name] = job
+        self.configured[name] = configured
+
+    def start(self) -> None:
+        """Starts queuing and running jobs, if not already started"""
+        if self._task is None:
+            self._last = dt.datetime.now(dt.timezone.utc) - CATCH_UP
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except Exception:  # keep the scheduler alive, the next tick catches up
+                logger.error(f"Error in daily scheduler\n{traceback.format_exc()}")
+            await asyncio.sleep(TICK)
+
+    async def tick(self, now: dt.datetime | None = None) -> None:
+        """Queues the jobs of the guilds that became due since the previous tick, then runs
+        the queued jobs that are due
+
+        Args:
+            now (dt.datetime | None, optional): time of this tick. Defaults to now.
+        """
+        now = now or dt.datetime.now(dt.timezone.utc)
+        await self.enqueue(self._last, now)
+        self._last = now
+        while await self.work(now) == BATCH:
+            pass
+        if now.timestamp() - self._pruned > KEEP.total_seconds():
+            await db.named_void_sql("daily_job_prune", (int((now - KEEP).timestamp()),))
+            self._pruned = now.timestamp()
+
+    async def enqueue(self, since: dt.datetime, now: dt.datetime) -> None:
+        """Queues the configured jobs of the guilds that became due between two instants
+
+        Args:
+            since (dt.datetime): previous check (exclusive)
+            now (dt.datetime): this check (inclusive)
+        """
+        rows: list[tuple[int, str, str, int]] = []
+        for (guild_id, guild) in (await settings.cache.all()).items():
+            day = due_day(guild_id, guild.time_zone, since, now)
+            if day is not None:
+                rows += [(guild_id, name, day.isoformat(), int(now.timestamp()))
+                         for (name, configured) in self.configured.items() if configured(guild)]
+        for start in range(0, len(rows), BATCH):
+            chunk = rows[start:start + BATCH]
+            await db.single_void_SQL(
+                "INSERT INTO DailyJobs (GuildID, Feature, Day, RunAt) VALUES " +
+                ", ".join(["(%s, %s, %s, %s)"] * len(chunk)) + " ON CONFLICT DO NOTHING",
+                tuple(value for row in chunk for value in row))
+
+    async def work(self, now: dt.datetime) -> int:
+        """Claims a batch of due jobs and runs them
+
+        Args:
+            now (dt.datetime): current time
+
+        Returns:
+            int: number of jobs claimed
+        """
+        claimed = await db.named_sql("daily_job_claim", (
+            int(now.timestamp()) + LEASE, int(now.timestamp()), MAX_ATTEMPTS, BATCH))
+        batches: dict[tuple[str, str], list[int]] = {}
+        last_attempts: set[tuple[str, str, int]] = set()
+        for (guild_id, feature, day, attempts) in claimed:
+            batches.setdefault((feature, day), []).append(guild_id)
+            if attempts >= MAX_ATTEMPTS:
+                last_attempts.add((feature, day, guild_id))
+        await asyncio.gather(*[
+            self._call(feature, day, guild_ids, now,
+                       {guild_id for guild_id in guild_ids
+                        if (feature, day, guild_id) in last_attempts})
+            for ((feature, day), guild_ids) in batches.items()])
+        return len(claimed)
+
+    async def _call(self, feature: str, day: str, guild_ids: list[int], now: dt.datetime,
+                    last_attempts: set[int]) -> None:
+        job = self.jobs.get(feature)
+        retry = set(guild_ids)
+        if job is None:
+            logger.error(f"Daily job {feature} is not registered in this process")
+        else:
+            try:
+                retry = await job(guild_ids, dt.date.fromisoformat(day)) & retry
+            except Exception:  # one failing job must not stop the others
+                logger.error(f"Error in daily job {feature}\n{traceback.format_exc()}")
+        given_up = retry & last_attempts
+        retry -= given_up
+        # given up jobs are finished too (their Attempts tell them apart), so they leave the
+        # queue instead of being scanned past by every claim until they are pruned
+        done = [guild_id for guild_id in guild_ids if guild_id not in retry]
+        if done:
+            await db.named_void_sql("daily_job_done", (feature, day, done))
+        if retry:
+            await db.named_void_sql("daily_job_retry",
+                                    (int(now.timestamp()), BACKOFF, feature, day, list(retry)))
+            logger.warning(f"Retrying daily job {feature} of {day} for {len(retry)} guilds")
+        for guild_id in given_up:
+            logger.error(f"Giving up daily job {feature} of {day}", guild_id=guild_id)
+
+
+scheduler = DailyScheduler()
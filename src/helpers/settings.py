@@ -0,0 +1,660 @@
+import abc
+import asyncio
+import json
+import traceback
+import typing
+import uuid
+from dataclasses import dataclass, field
+
+from discord import PartialEmoji
+
+import helpers.database as db
+from helpers.emoji import Emoji, emoji_key
+from helpers.logger import Logger
+from helpers.metrics import CacheStats
+
+logger = Logger()
+
+T = typing.TypeVar("T")
+
+NOTIFY_CHANNEL = "nix_cache"
+ORIGIN = uuid.uuid4().hex  # identifies this process, so it skips its own invalidations
+
+
+class GuildCache(abc.ABC, typing.Generic[T]):
+    """In-memory copy of a per-guild setting, so hot paths need no database round trip
+
+    Loaded in bulk by load() and kept current by the commands and events that change the
+    setting (after writing it to the database). Until loaded guilds are read on demand, as
+    are guilds invalidated by another process. Subclasses implement _load_all and _load_guild.
+
+    Args:
+        name (str): name of the cache (for reporting)
+    """
+
+    def __init__(self, name: str) -> None:
+        self._guilds: dict[int, T] = {}
+        self._stale: set[int] = set()  # guilds changed by another process, read on next use
+        self.loaded = False
+        self.stats = CacheStats(name)
+
+    @abc.abstractmethod
+    async def _load_all(self) -> dict[int, T]:
+        """Reads the value of every guild from the database"""
+
+    @abc.abstractmethod
+    async def _load_guild(self, guild_id: int) -> T | None:
+        """Reads the value of a guild from the database, None if it has none"""
+
+    async def load(self) -> None:
+        """Loads every guild, unless already loaded"""
+        if self.loaded:
+            return
+        guilds = await self._load_all()
+        self._guilds = guilds | self._guilds  # entries cached meanwhile are as new
+        self.loaded = True
+        logger.info(f"Loaded {self.stats.name} for {len(guilds)} guilds")
+
+    async def get(self, guild_id: int) -> T | None:
+        """Gets the cached value of a guild
+
+        Args:
+            guild_id (int): ID of the guild
+
+        Returns:
+            T | None: value for the guild, None if it has none
+        """
+        value = self._guilds.get(guild_id)
+        if value is not None or (self.loaded and guild_id not in self._stale):
+            self.stats.hit()
+            return value
+        self.stats.miss()
+        self._stale.discard(guild_id)
+        value = await self._load_guild(guild_id)
+        if value is None:
+            return None
+        return self._guilds.setdefault(guild_id, value)
+
+    async def all(self) -> dict[int, T]:
+        """Gets the cached values of every guild
+
+        Returns:
+            dict[int, T]: value of each guild by guild ID
+        """
+        await self.load()
+        for guild_id in list(self._stale):
+            await self.get(guild_id)
+        return self._guilds
+
+    def remove_guild(self, guild_id: int) -> None:
+        """Drops a guild that was left
+
+        Args:
+            guild_id (int): ID of the guild
+        """
+        if guild_id in self._guilds:
+            del self._guilds[guild_id]
+
+    def invalidate(self, guild_id: int, key: int | None = None) -> None:
+        """Evicts a guild changed by another process, it is read again on next use
+
+        Args:
+            guild_id (int): ID of the guild
+            key (int | None, optional): changed channel or message (the whole guild is evicted)
+        """
+        self.remove_guild(guild_id)
+        self._stale.add(guild_id)
+
+    def reset(self) -> None:
+        """Forgets everything (e.g. after invalidations may have been missed)"""
+        self._guilds = {}
+        self._stale.clear()
+        self.loaded = False
+
+    def _cached(self, guild_id: int | None) -> T | None:
+        return self._guilds.get(guild_id) if guild_id else None
+
+
+@dataclass
+class GuildSettings:
+    """Cached settings of a guild: its Guilds row, counting channels and subreddits"""
+    birthday_channel: int | None = None
+    fact_channel: int | None = None
+    counting: dict[int, int | None] = field(default_factory=dict)  # channel ID: fail role ID
+    subreddits: dict[str, int] = field(default_factory=dict)  # subreddit: channel ID
+    time_zone: str | None = None  # IANA name, None for UTC
+
+
+class SettingsCache(GuildCache[GuildSettings]):
+    """Cache of every guild's settings"""
+
+    def __init__(self) -> None:
+        super().__init__("guild settings")
+
+    async def _load_all(self) -> dict[int, GuildSettings]:
+        guilds = {guild_id: GuildSettings(birthday, fact, time_zone=time_zone)
+                  for (guild_id, birthday, fact, time_zone) in await db.single_sql(
+                      "SELECT ID, BirthdayChannelID, FactChannelID, TimeZone FROM Guilds")}
+        for (guild_id, channel_id, fail_role) in await db.single_sql(
+                "SELECT GuildID, ChannelID, FailRoleID FROM Counting"):
+            if guild_id in guilds:
+                guilds[guild_id].counting[channel_id] = fail_role
+        for (guild_id, subreddit, channel_id) in await db.single_sql(
+                "SELECT GuildID, Subreddit, SubredditChannelID FROM Subreddits"):
+            if guild_id in guilds:
+                guilds[guild_id].subreddits[subreddit] = channel_id
+        return guilds
+
+    async def _load_guild(self, guild_id: int) -> GuildSettings | None:
+        rows = await db.single_sql(
+            "SELECT BirthdayChannelID, FactChannelID, TimeZone FROM Guilds WHERE ID=%s",
+            (guild_id,))
+        if not rows:
+            return None
+        return GuildSettings(rows[0][0], rows[0][1], {
+            channel_id: fail_role for (channel_id, fail_role) in await db.single_sql(
+                "SELECT ChannelID, FailRoleID FROM Counting WHERE GuildID=%s", (guild_id,))}, {
+            subreddit: channel_id for (subreddit, channel_id) in await db.single_sql(
+                "SELECT Subreddit, SubredditChannelID FROM Subreddits WHERE GuildID=%s",
+                (guild_id,))}, rows[0][2])
+
+    def add_guild(self, guild_id: int) -> None:
+        """Caches the (empty) settings of a newly joined guild
+
+        Args:
+            guild_id (int): ID of the guild
+        """
+        self._guilds[guild_id] = GuildSettings()
+
+    def set_birthday_channel(self, guild_id: int | None, channel_id: int | None) -> None:
+        """Sets the birthday channel of a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            channel_id (int | None): ID of the birthday channel (None if unset)
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.birthday_channel = channel_id
+
+    def set_fact_channel(self, guild_id: int | None, channel_id: int | None) -> None:
+        """Sets the fact channel of a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            channel_id (int | None): ID of the fact channel (None if unset)
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.fact_channel = channel_id
+
+    def set_time_zone(self, guild_id: int | None, time_zone: str | None) -> None:
+        """Sets the time zone of a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            time_zone (str | None): IANA name of the time zone (None for UTC)
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.time_zone = time_zone
+
+    def add_counting(self, guild_id: int | None, channel_id: int) -> None:
+        """Adds a counting channel (keeping its fail role if it already was one) to a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            channel_id (int): ID of the counting channel
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.counting.setdefault(channel_id, None)
+
+    def set_fail_role(self, guild_id: int | None, channel_id: int, role_id: int | None) -> None:
+        """Sets the fail role of a counting channel of a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            channel_id (int): ID of the counting channel
+            role_id (int | None): ID of the fail role (None if unset)
+        """
+        settings = self._cached(guild_id)
+        if settings is not None and channel_id in settings.counting:
+            settings.counting[channel_id] = role_id
+
+    def remove_counting(self, guild_id: int | None, channel_id: int) -> None:
+        """Removes a counting channel (e.g. stopped or deleted) of a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            channel_id (int): ID of the counting channel
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.counting.pop(channel_id, None)
+
+    def subscribe(self, guild_id: int | None, subreddit: str, channel_id: int) -> None:
+        """Adds a subreddit subscription to a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            subreddit (str): name of the subreddit (lower case)
+            channel_id (int): ID of the channel to post in
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.subreddits[subreddit] = channel_id
+
+    def unsubscribe(self, guild_id: int | None, subreddit: str) -> None:
+        """Removes a subreddit subscription of a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            subreddit (str): name of the subreddit (lower case)
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.subreddits.pop(subreddit, None)
+
+    def remove_channel(self, guild_id: int | None, channel_id: int) -> None:
+        """Drops the counting and subscriptions of a (deleted) channel of a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            channel_id (int): ID of the channel
+        """
+        settings = self._cached(guild_id)
+        if settings is not None:
+            settings.counting.pop(channel_id, None)
+            settings.subreddits = {subreddit: channel for (subreddit, channel)
+                                   in settings.subreddits.items() if channel != channel_id}
+
+
+@dataclass
+class GuildChains:
+    """Cached chain messages of a guild and the users already chained by each"""
+    responses: dict[int, tuple[int, str]] = field(default_factory=dict)  # watched: (resp, msg)
+    chained: dict[int, set[int]] = field(default_factory=dict)  # watched channel ID: user IDs
+
+
+class ChainCache(GuildCache[GuildChains]):
+    """Cache of every guild's MessageChain and ChainedUsers rows"""
+
+    def __init__(self) -> None:
+        super().__init__("chain messages")
+
+    async def _load_all(self) -> dict[int, GuildChains]:
+        guilds: dict[int, GuildChains] = {}
+        for (guild_id, watched, response, message) in await db.single_sql(
+                "SELECT GuildID, WatchedChannelID, ResponseChannelID, Message FROM MessageChain"):
+            chains = guilds.setdefault(guild_id, GuildChains())
+            chains.responses[watched] = (response, message)
+            chains.chained[watched] = set()
+        for (guild_id, user_id, channel_id) in await db.single_sql(
+                "SELECT GuildID, UserID, ChannelID FROM ChainedUsers"):
+            guilds[guild_id].chained[channel_id].add(user_id)
+        return guilds
+
+    async def _load_guild(self, guild_id: int) -> GuildChains | None:
+        chains = GuildChains()
+        for (watched, response, message) in await db.named_sql("chain_messages", (guild_id,)):
+            chains.responses[watched] = (response, message)
+            chains.chained[watched] = set()
+        for (user_id, channel_id) in await db.single_sql(
+                "SELECT UserID, ChannelID FROM ChainedUsers WHERE GuildID=%s", (guild_id,)):
+            chains.chained[channel_id].add(user_id)
+        return chains
+
+    def add_chain(self, guild_id: int | None, watched: int, response: int, message: str) -> None:
+        """Adds a chain message to a cached guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+            watched (int): ID of the watched channel (-1 for all channels)
+            response (int): ID of the channel to respond in
+            message (str): message to respond with
+        """
+        if guild_id and (self.loaded or guild_id in self._guilds):
+            chains = self._guilds.setdefault(guild_id, GuildChains())
+            chains.responses[watched] = (response, message)
+            chains.chained[watched] = set()
+
+    def add_chained(self, guild_id: int, watched: int, user_id: int) -> None:
+        """Marks a user as chained by a chain message of a cached guild
+
+        Args:
+            guild_id (int): ID of the guild
+            watched (int): ID of the watched channel of the chain
+            user_id (int): ID of the user
+        """
+        chains = self._cached(guild_id)
+        if chains is not None and watched in chains.chained:
+            chains.chained[watched].add(user_id)
+
+    def remove_channel(self, guild_id: int, channel_id: int) -> None:
+        """Drops the chains watching or responding in a (deleted) channel of a cached guild
+
+        Args:
+            guild_id (int): ID of the guild
+            channel_id (int): ID of the channel
+        """
+        chains = self._cached(guild_id)
+        if chains is None:
+            return
+        for (watched, (response, _)) in list(chains.responses.items()):
+            if channel_id in [watched, response]:
+                del chains.responses[watched]
+                del chains.chained[watched]
+
+    def remove_member(self, guild_id: int, user_id: int) -> None:
+        """Forgets that a (departed) member was chained in a cached guild
+
+        Args:
+            guild_id (int): ID of the guild
+            user_id (int): ID of the member
+        """
+        chains = self._cached(guild_id)
+        if chains is not None:
+            for users in chains.chained.values():
+                users.discard(user_id)
+
+
+K = typing.TypeVar("K")
+
+
+class KeyedCache(abc.ABC, typing.Generic[K]):
+    """In-memory copy of per-channel or per-message role rules, so a lookup is one dict access
+
+    Loaded in bulk by load() and kept current by the commands and events that change the
+    rules (after writing them to the database). Until loaded keys are read on demand, as
+    are keys invalidated by another process. Subclasses implement _load_all and _load_key.
+
+    Args:
+        name (str): name of the cache (for reporting)
+    """
+
+    def __init__(self, name: str) -> None:
+        self._entries: dict[int, dict[K, typing.Any]] = {}
+        self._guild_of: dict[int, int] = {}  # key: guild ID
+        self._stale: set[int] = set()  # keys changed by another process, read on next use
+        self.loaded = False
+        self.stats = CacheStats(name)
+
+    @abc.abstractmethod
+    async def _load_all(self) -> dict[int, dict[K, typing.Any]]:
+        """Reads the rules of every key from the database"""
+
+    @abc.abstractmethod
+    async def _load_key(self, key: int) -> dict[K, typing.Any]:
+        """Reads the rules of a key from the database, empty if it has none"""
+
+    async def load(self) -> None:
+        """Loads every entry, unless already loaded"""
+        if self.loaded:
+            return
+        entries = await self._load_all()
+        self._entries = {key: rules for (key, rules)
+                         in (entries | self._entries).items() if rules}
+        self.loaded = True
+        logger.info(f"Loaded {self.stats.name} for {len(self._entries)} keys")
+
+    async def _get(self, key: int) -> dict[K, typing.Any]:
+        rules = self._entries.get(key)
+        if rules is not None or (self.loaded and key not in self._stale):
+            self.stats.hit()
+            return rules or {}
+        self.stats.miss()
+        self._stale.discard(key)
+        return self._entries.setdefault(key, await self._load_key(key))
+
+    def _add(self, guild_id: int | None, key: int) -> dict[K, typing.Any] | None:
+        if guild_id:
+            self._guild_of[key] = guild_id
+        if self.loaded or key in self._entries:
+            return self._entries.setdefault(key, {})
+        return None
+
+    def remove_guild(self, guild_id: int | None) -> None:
+        """Drops every entry of a guild
+
+        Args:
+            guild_id (int | None): ID of the guild
+        """
+        for key in self._keys_of(guild_id):
+            self.remove(key)
+
+    def remove(self, key: int) -> None:
+        """Drops an entry (e.g. of a deleted channel)
+
+        Args:
+            key (int): ID of the channel or message
+        """
+        if key in self._entries:
+            del self._entries[key]
+        self._guild_of.pop(key, None)
+
+    def invalidate(self, guild_id: int, key: int | None = None) -> None:
+        """Evicts an entry changed by another process, it is read again on next use
+
+        Args:
+            guild_id (int): ID of the guild
+            key (int | None, optional): ID of the channel or message. Defaults to every
+                entry of the guild.
+        """
+        keys = [key] if key is not None else self._keys_of(guild_id)
+        for stale in keys:
+            self._entries.pop(stale, None)
+            self._guild_of[stale] = guild_id  # kept so remove_guild still finds the key
+        self._stale.update(keys)
+
+    def reset(self) -> None:
+        """Forgets everything (e.g. after invalidations may have been missed)"""
+        self._entries = {}
+        self._guild_of = {}
+        self._stale.clear()
+        self.loaded = False
+
+    def _keys_of(self, guild_id: int | None) -> list[int]:
+        if not self.loaded:  # keys read on demand have no known guild, so forget them all
+            return list(self._entries)
+        return [key for (key, guild) in self._guild_of.items()
+                if guild == guild_id and key in self._entries]
+
+
+class RoleChannelCache(KeyedCache[int]):
+    """Cache of the RoleChannel rules, keyed by channel"""
+
+    def __init__(self) -> None:
+        super().__init__("role channels")
+
+    async def _load_all(self) -> dict[int, dict[int, typing.Any]]:
+        channels: dict[int, dict[int, typing.Any]] = {}
+        for (guild_id, role_id, channel_id, add_role) in await db.single_sql(
+                "SELECT GuildID, RoleID, ChannelID, ToAdd FROM RoleChannel"):
+            channels.setdefault(channel_id, {})[role_id] = bool(add_role)
+            self._guild_of.setdefault(channel_id, guild_id)
+        return channels
+
+    async def _load_key(self, key: int) -> dict[int, typing.Any]:
+        return {role_id: bool(add_role) for (role_id, add_role)
+                in await db.named_sql("role_channel_rules", (key,))}
+
+    async def get(self, channel_id: int) -> dict[int, bool]:
+        """Gets the role rules of a channel
+
+        Args:
+            channel_id (int): ID of the channel
+
+        Returns:
+            dict[int, bool]: whether to add (or else remove) each role ID, empty if no rules
+        """
+        return await self._get(channel_id)
+
+    def add_rule(self, guild_id: int | None, channel_id: int, role_id: int, add_role: bool) -> None:
+        """Adds a rule assigning (or removing) a role on messages in a channel
+
+        Args:
+            guild_id (int | None): ID of the guild
+            channel_id (int): ID of the channel
+            role_id (int): ID of the role
+            add_role (bool): True to add the role, False to remove it
+        """
+        rules = self._add(guild_id, channel_id)
+        if rules is not None:
+            rules[role_id] = add_role
+
+    def remove_role(self, guild_id: int | None, role_id: int) -> None:
+        """Drops every rule of a guild for a role
+
+        Args:
+            guild_id (int | None): ID of the guild
+            role_id (int): ID of the role
+        """
+        for channel_id in self._keys_of(guild_id):
+            self._entries[channel_id].pop(role_id, None)
+            if not self._entries[channel_id]:
+                self.remove(channel_id)
+
+
+class ReactionRoleCache(KeyedCache[int | str]):
+    """Cache of the ReactMessages roles, keyed by message with the emoji already parsed"""
+
+    def __init__(self) -> None:
+        super().__init__("reaction roles")
+
+    @staticmethod
+    def _parse(rows: list[tuple[typing.Any, ...]]) -> dict[int | str, typing.Any]:
+        roles: dict[int | str, list[int]] = {}
+        for (emoji, role_id) in rows:
+            roles.setdefault(emoji_key(Emoji(emoji).to_partial_emoji()), []).append(role_id)
+        return roles
+
+    async def _load_all(self) -> dict[int, dict[int | str, typing.Any]]:
+        rows: dict[int, list[tuple[typing.Any, ...]]] = {}
+        for (guild_id, message_id, emoji, role_id) in await db.single_sql(
+                "SELECT GuildID, MessageID, Emoji, RoleID FROM ReactMessages"):
+            rows.setdefault(message_id, []).append((emoji, role_id))
+            self._guild_of.setdefault(message_id, guild_id)
+        return {message_id: self._parse(message_rows)
+                for (message_id, message_rows) in rows.items()}
+
+    async def _load_key(self, key: int) -> dict[int | str, typing.Any]:
+        return self._parse(await db.named_sql("react_roles", (key,)))
+
+    async def get(self, message_id: int, emoji: PartialEmoji) -> list[int]:
+        """Gets the roles assigned by reacting to a message with an emoji
+
+        Args:
+            message_id (int): ID of the message
+            emoji (PartialEmoji): emoji reacted with
+
+        Returns:
+            list[int]: IDs of the roles, empty if none
+        """
+        return typing.cast(list[int], (await self._get(message_id)).get(emoji_key(emoji), []))
+
+    def add_role(
+        self,
+        guild_id: int | None,
+        message_id: int,
+        emoji: PartialEmoji,
+        role_id: int
+    ) -> None:
+        """Adds a role assigned by reacting to a message with an emoji
+
+        Args:
+            guild_id (int | None): ID of the guild
+            message_id (int): ID of the message
+            emoji (PartialEmoji): emoji to react with
+            role_id (int): ID of the role
+        """
+        roles = self._add(guild_id, message_id)
+        if roles is not None:
+            roles.setdefault(emoji_key(emoji), []).append(role_id)
+
+    def remove_role(self, guild_id: int | None, role_id: int) -> None:
+        """Drops every reaction of a guild assigning a role
+
+        Args:
+            guild_id (int | None): ID of the guild
+            role_id (int): ID of the role
+        """
+        for message_id in self._keys_of(guild_id):
+            roles = self._entries[message_id]
+            for key in list(roles):
+                roles[key] = [role for role in roles[key] if role != role_id]
+                if not roles[key]:
+                    del roles[key]
+            if not roles:
+                self.remove(message_id)
+
+
+cache = SettingsCache()
+chains = ChainCache()
+role_channels = RoleChannelCache()
+react_roles = ReactionRoleCache()
+_listening = False
+_reloads: set[asyncio.Task[None]] = set()
+
+
+CACHES: dict[str, GuildCache[typing.Any] | KeyedCache[typing.Any]] = {
+    "settings": cache, "chains": chains, "role_channels": role_channels,
+    "react_roles": react_roles}
+
+
+def _on_notify(payload: str | None) -> None:
+    """Applies an invalidation published by another process
+
+    Args:
+        payload (str | None): the published event, None if events may have been missed
+    """
+    if payload is None:
+        logger.warning("Cache invalidations may have been missed, reloading caches")
+        for missed in CACHES.values():
+            missed.reset()
+        task = asyncio.create_task(_reload())
+        _reloads.add(task)
+        task.add_done_callback(_reloads.discard)
+        return
+    event = json.loads(payload)
+    if event["origin"] == ORIGIN:
+        return
+    for name in event["caches"]:
+        CACHES[name].invalidate(event["guild"], event["key"])
+
+
+async def publish(caches: list[str], guild_id: int | None, key: int | None = None) -> None:
+    """Tells the other processes to evict a changed guild (or one of its keys) from caches
+
+    Called after the change was written to the database and applied to this process'
+    caches. Does nothing with SQLite, which only serves one process.
+
+    Args:
+        caches (list[str]): names of the changed caches (keys of CACHES)
+        guild_id (int | None): ID of the guild
+        key (int | None, optional): ID of the changed channel or message. Defaults to None.
+    """
+    if guild_id is None:
+        return
+    await db.notify(NOTIFY_CHANNEL, json.dumps(
+        {"origin": ORIGIN, "caches": caches, "guild": guild_id, "key": key}))
+
+
+async def _reload() -> None:
+    """Loads the caches again after a reset (until then they read guilds on demand)"""
+    try:
+        await load()
+    except Exception:  # the caches keep reading on demand, all() retries the bulk load
+        logger.error(f"Failed to reload caches\n{traceback.format_exc()}")
+
+
+async def load() -> None:
+    """Starts listening for invalidations and loads every cache in bulk, unless already loaded"""
+    global _listening
+    if not _listening:
+        _listening = True
+        await db.listen(NOTIFY_CHANNEL, _on_notify)
+    await cache.load()
+    await chains.load()
+    await role_channels.load()
+    await react_roles.load()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import typing
+
+from helpers.logger import Logger
+
+logger = Logger()
+
+TEMPLATE_DIR = os.path.join(tempfile.gettempdir(), "nix-test-db")
+
+_server: typing.Any = None
+
+
+def _template() -> str:
+    """Gets the cached template data directory, building it if it does not exist yet
+
+    The template is a stopped cluster that is already migrated and populated, so each run
+    only has to copy it rather than run initdb and create the schema. It is keyed by the
+    latest migration version, delete it to force a rebuild for other changes.
+
+    Returns:
+        str: path to the template data directory
+    """
+    import testing.postgresql as tp  # type: ignore[import]
+    import helpers.database as db
+    import helpers.migrations as migrations
+
+    path = f"{TEMPLATE_DIR}-v{migrations.latest_version()}"
+    if os.path.exists(path):
+        return path
+    logger.info(f"Building test database template {path}")
+    build = tempfile.mkdtemp(prefix="nix-test-db-build")
+    try:
+        server = tp.Postgresql(base_dir=build)
+        try:
+            migrations.migrate(server.url(), contract=True)
+            db.populate(server.url())
+        finally:
+            server.stop()
+        try:
+            os.rename(os.path.join(build, "data"), path)
+        except OSError:  # another process built it at the same time
+            pass
+    finally:
+        shutil.rmtree(build, ignore_errors=True)
+    return path
+
+
+def url() -> str:
+    """Gets the URL of the debug mode test server, starting it (from the template) on first use
+
+    Returns:
+        str: URL of the test database
+    """
+    global _server
+    if _server is None:
+        import testing.postgresql as tp
+        _server = tp.Postgresql(copy_data_from=_template())
+        logger.info("Started test database server")
+    return typing.cast(str, _server.url())
+
+
+def stop() -> None:
+    """Stops the test server, if it was started"""
+    global _server
+    if _server is not None:
+        _server.stop()
+        _server = None